@@ -1,44 +1,95 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
+import functools
+import uuid
 
 import azure_wrapper
 
+# Set operations over the members of N groups, elements of the symmetric difference are in an odd number of groups
+SET_OPERATIONS = {
+    'intersection': lambda sets: set.intersection(*sets),
+    'union': lambda sets: set.union(*sets),
+    'difference': lambda sets: set.difference(*sets),
+    'symmetric-difference': lambda sets: functools.reduce(set.symmetric_difference, sets),
+}
 
-def main(action, left, right):
-    if action not in ['add', 'remove', 'in']:
+
+def _compact(object_id):
+    """16 bytes instead of a 36 character string (or a whole user dict) per member, for groups with 50k+ members"""
+    return uuid.UUID(object_id).bytes
+
+
+def _expand(compact_id):
+    return str(uuid.UUID(bytes=compact_id))
+
+
+def get_member_sets(groups, jobs):
+    """
+    The compact member ids of each group, the groups are fetched in parallel
+    """
+    def member_set(group):
+        return {_compact(object_id) for object_id in azure_wrapper.iter_member_ids(group)}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(member_set, groups))
+
+
+def main(action, groups, jobs=4):
+    if action not in ['add', 'remove', 'in'] + list(SET_OPERATIONS):
         raise ValueError("{action} is not a supported action".format(action=action))
 
+    if action in SET_OPERATIONS:
+        member_ids = SET_OPERATIONS[action](get_member_sets(groups, jobs))
+        # Sorted, so the output is the same every run and can be diffed
+        for object_id in sorted(_expand(compact_id) for compact_id in member_ids):
+            print(object_id)
+        print("{count} members in the {action} of {groups}".format(
+            count=len(member_ids), action=action, groups=', '.join(groups))
+        )
+        return
+
+    if len(groups) != 2:
+        raise ValueError("{action} requires exactly two groups, left and right".format(action=action))
+
+    (left, right) = groups
     count = 0
-    left_members = azure_wrapper.get_users_in_group(left)
 
     if action == 'in':
-        count = len(left_members)
-        right_members = azure_wrapper.get_users_in_group(right)
+        (left_ids, right_ids) = get_member_sets(groups, jobs)
+        count = len(left_ids)
 
-        in_both = [x['objectId'] for x in left_members if x in right_members]
         print("Members in both groups:")
-        for user_id in in_both:
-            print(user_id)
+        for object_id in sorted(_expand(compact_id) for compact_id in left_ids & right_ids):
+            print(object_id)
     else:
-        for member in [x for x in left_members if x['objectType'] == 'User']:
-            print("Will {action} {mail} in {right}...".format(action=action, mail=member['mail'], right=right), end='')
-            if action == 'add':
-                azure_wrapper.add_group_member(right, member['objectId'])
-            elif action == 'remove':
-                azure_wrapper.remove_member_from_group(right, member['objectId'])
-            else:
-                raise ValueError("Internal error: {action} is supposed to be valid here".format(action=action))
+        left_members = azure_wrapper.get_users_in_group(left)
+        # Lists the members of right once, then adds/removes all users in bulk requests
+        users = [x for x in left_members if x['objectType'] == 'User']
+        object_ids = [x['objectId'] for x in users]
+        print("Will {action} {count} users in {right}...".format(action=action, count=len(users), right=right))
+        if action == 'add':
+            report = azure_wrapper.add_group_members(right, object_ids)
+        elif action == 'remove':
+            report = azure_wrapper.remove_group_members(right, object_ids)
+        else:
+            raise ValueError("Internal error: {action} is supposed to be valid here".format(action=action))
+
+        for member in users:
+            print("{mail}: {outcome}".format(mail=member['mail'], outcome=report[member['objectId']]))
             count += 1
-            print('Done')
 
     print("{count} users processed".format(count=count))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument("--action", help="Export of active users in JIRA", required=True, choices=['add', 'remove', 'in'])
-    parser.add_argument("left", help="The left group to apply action with")
-    parser.add_argument("right", help="The right group to apply action with")
+    parser.add_argument("--action", help="Action to apply on the groups", required=True,
+                        choices=['add', 'remove', 'in'] + list(SET_OPERATIONS))
+    parser.add_argument("--jobs", type=int, default=4, help="Number of groups fetched in parallel")
+    parser.add_argument("groups", nargs='+',
+                        help="add/remove/in: the left and right group, set operations: two or more groups, the "
+                             "difference being the members of the first group in none of the others")
     args = parser.parse_args()
 
-    main(args.action, args.left, args.right)
+    main(args.action, args.groups, args.jobs)
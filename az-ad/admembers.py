@@ -6,7 +6,10 @@ import azure_wrapper
 
 def main(args):
     # azure_wrapper.remove_members_from_group(args.group)
-    azure_wrapper.copy_members(args.from_group, args.to_group)
+    report = azure_wrapper.copy_members(args.from_group, args.to_group)
+    for (object_id, outcome) in report.items():
+        print("{object_id}: {outcome}".format(object_id=object_id, outcome=outcome))
+    print("{count} members copied".format(count=sum(1 for outcome in report.values() if outcome == 'added')))
 
 
 if __name__ == '__main__':
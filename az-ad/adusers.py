@@ -1,26 +1,105 @@
 #!/usr/bin/env python3
 
 import argparse
+import itertools
 import json
+import os
 
 import azure_wrapper
 
 
-def main(json_file, group):
-    with open(json_file) as json_stream:
-        active_user_data = json.load(json_stream)
+def iter_json_array(stream, chunk_size=64 * 1024):
+    """
+    Yields the objects of the JSON array in stream one at a time, without reading the whole file in memory
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    started = False
+    while True:
+        buffer = buffer.lstrip()
+        if not buffer or not started:
+            chunk = stream.read(chunk_size)
+            if not chunk and not buffer:
+                raise ValueError("Unexpected end of JSON array")
+            buffer = (buffer + chunk).lstrip()
+            if not started and buffer:
+                if buffer[0] != '[':
+                    raise ValueError("Expected a JSON array")
+                buffer = buffer[1:]
+                started = True
+            continue
+
+        if buffer[0] == ']':
+            return
+        if buffer[0] == ',':
+            buffer = buffer[1:]
+            continue
+
+        try:
+            (item, end) = decoder.raw_decode(buffer)
+        except ValueError:
+            # The object continues in the next chunk
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                raise
+            buffer += chunk
+            continue
+
+        yield item
+        buffer = buffer[end:]
+
+
+def load_cache(cache_file):
+    if not cache_file or not os.path.exists(cache_file):
+        return {}
+
+    with open(cache_file) as f:
+        return json.load(f)
 
-    count = 0
-    for user in active_user_data:
-        email = user['emailAddress']
-        azure_user = azure_wrapper.find_user_by_email(email)
 
+def save_cache(cache_file, cache):
+    if cache_file:
+        with open(cache_file, 'w') as f:
+            json.dump(cache, f)
+
+
+def resolve_emails(emails, cache):
+    """
+    {email: objectId or None}, emails not in cache ({lower case email: objectId}) are looked up in bulk and cached if
+    found
+    """
+    missing = [email for email in emails if email.lower() not in cache]
+    for (email, azure_user) in azure_wrapper.find_users_by_email(missing).items():
         if azure_user:
-            azure_wrapper.add_group_member(group, azure_user['objectId'])
-            print("User: {email} now in group".format(email=email))
-        else:
-            print("User: {email} not found in Azure".format(email=email))
-        count += 1
+            cache[email.lower()] = azure_user['objectId']
+
+    return {email: cache.get(email.lower()) for email in emails}
+
+
+def main(json_file, group, cache_file=None, batch_size=1000):
+    cache = load_cache(cache_file)
+    index = azure_wrapper.GroupMembershipIndex()
+    count = 0
+    try:
+        with open(json_file) as json_stream:
+            users = iter_json_array(json_stream)
+            # Users are resolved and added batch_size at a time, never holding the whole export in memory
+            for batch in iter(lambda: list(itertools.islice(users, batch_size)), []):
+                object_ids = resolve_emails([user['emailAddress'] for user in batch], cache)
+                report = azure_wrapper.add_group_members(group, [i for i in object_ids.values() if i], index)
+
+                for user in batch:
+                    email = user['emailAddress']
+                    object_id = object_ids[email]
+                    if not object_id:
+                        print("User: {email} not found in Azure".format(email=email))
+                    elif isinstance(report[object_id], Exception):
+                        print("User: {email} not added: {error}".format(email=email, error=report[object_id]))
+                    else:
+                        print("User: {email} now in group ({outcome})".format(email=email, outcome=report[object_id]))
+                    count += 1
+    finally:
+        save_cache(cache_file, cache)
 
     print("{count} users processed".format(count=count))
 
@@ -29,5 +108,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--json", help="List of json objects containing emailAddress", required=True)
     parser.add_argument("--group", help="The group to add users to", required=True)
+    parser.add_argument("--cache", help="Cache email to objectId lookups in this file between runs")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Users resolved and added at a time")
     args = parser.parse_args()
-    main(args.json, args.group)
+    main(args.json, args.group, args.cache, args.batch_size)
@@ -1,7 +1,9 @@
+import concurrent.futures
 import json
+import os
 import subprocess
 
-# TODO: Migrate this module to use the graph api instead of relying on local az cli
+# Uses the local az cli by default, set AZURE_WRAPPER_BACKEND=graph to use the Graph API instead (see graph_wrapper)
 
 
 # Internal helper methods #
@@ -39,23 +41,88 @@ def find_user_by_email(email):
     return None
 
 
+def find_users_by_email(emails, chunk_size=15):
+    """
+    Search for many users by email, chunk_size emails per query (Graph allows at most 15 'or' clauses per filter).
+    Returns {email: User, or None if not found (or not unique)}
+    """
+    emails = list(dict.fromkeys(emails))
+    result = {}
+    for i in range(0, len(emails), chunk_size):
+        chunk = emails[i:i + chunk_size]
+        search_filter = ' or '.join("mail eq '{mail}'".format(mail=email.replace("'", "''")) for email in chunk)
+        matches = {}
+        for user in filter_users(search_filter):
+            matches.setdefault((user.get('mail') or '').lower(), []).append(user)
+
+        for email in chunk:
+            users = matches.get(email.lower(), [])
+            result[email] = users[0] if len(users) == 1 else None
+    return result
+
+
 def get_member_groups(object_id):
     command = "az ad user get-member-groups --upn-or-object-id {object_id}".format(object_id=object_id)
     return _run(command)
 
 
 # Group centric functions #
-def add_group_member(group_name, object_id):
-    if user_in_group(object_id, group_name):
-        return
-
+def _add_member(group_name, object_id):
     command = 'az ad group member add --group "{group}" --member-id {object_id}'.format(
         group=group_name, object_id=object_id
     )
+    _run_no_return(command)
 
+
+def _remove_member(group_name, object_id):
+    command = 'az ad group member remove --group "{group}" --member-id {member_id}'.format(
+        group=group_name, member_id=object_id
+    )
     _run_no_return(command)
 
 
+def _add_members(group_name, object_ids):
+    """
+    Add each object_id, returns {object_id: None if added, or the error}. The graph backend adds members in bulk instead
+    """
+    errors = {}
+    for object_id in object_ids:
+        try:
+            _add_member(group_name, object_id)
+            errors[object_id] = None
+        except Exception as e:
+            errors[object_id] = e
+    return errors
+
+
+def _remove_members(group_name, object_ids):
+    """
+    Remove each object_id, returns {object_id: None if removed, or the error}. The graph backend uses batch requests
+    """
+    errors = {}
+    for object_id in object_ids:
+        try:
+            _remove_member(group_name, object_id)
+            errors[object_id] = None
+        except Exception as e:
+            errors[object_id] = e
+    return errors
+
+
+def add_group_member(group_name, object_id, index=None):
+    """
+    Add a member unless already a member, checked using index (GroupMembershipIndex) when given
+    """
+    if index is not None:
+        return index.add(group_name, object_id)
+
+    if user_in_group(object_id, group_name):
+        return False
+
+    _add_member(group_name, object_id)
+    return True
+
+
 def user_in_group(object_id, group_name):
     """
     get_member_groups:
@@ -73,18 +140,63 @@ def get_users_in_group(group_name):
     return _run(command)
 
 
-def remove_member_from_group(group_name, object_id):
-    if user_in_group(object_id, group_name):
-        command = 'az ad group member remove --group "{group}" --member-id {member_id}'.format(
-            group=group_name, member_id=object_id
-        )
-        _run_no_return(command)
+def iter_member_ids(group_name):
+    """
+    Yields the objectId of each member, the graph backend streams them page by page
+    """
+    for member in get_users_in_group(group_name):
+        yield member['objectId']
+
+
+def remove_member_from_group(group_name, object_id, index=None):
+    """
+    Remove a member if it is a member, checked using index (GroupMembershipIndex) when given
+    """
+    if index is not None:
+        return index.remove(group_name, object_id)
+
+    if not user_in_group(object_id, group_name):
+        return False
+
+    _remove_member(group_name, object_id)
+    return True
+
+
+def add_group_members(group_name, object_ids, index=None):
+    """
+    Add the object_ids that are not already members in bulk.
+    Returns {object_id: outcome}, outcome being 'added', 'already member' or the error
+    """
+    index = index or GroupMembershipIndex()
+    members = index.get(group_name)
+    report = {object_id: 'already member' for object_id in object_ids if object_id in members}
+    missing = [object_id for object_id in dict.fromkeys(object_ids) if object_id not in members]
+    for (object_id, error) in _add_members(group_name, missing).items():
+        if error is None:
+            members.add(object_id)
+        report[object_id] = error or 'added'
+    return report
+
+
+def remove_group_members(group_name, object_ids, index=None):
+    """
+    Remove the object_ids that are members in bulk.
+    Returns {object_id: outcome}, outcome being 'removed', 'not a member' or the error
+    """
+    index = index or GroupMembershipIndex()
+    members = index.get(group_name)
+    report = {object_id: 'not a member' for object_id in object_ids if object_id not in members}
+    present = [object_id for object_id in dict.fromkeys(object_ids) if object_id in members]
+    for (object_id, error) in _remove_members(group_name, present).items():
+        if error is None:
+            members.discard(object_id)
+        report[object_id] = error or 'removed'
+    return report
 
 
 def remove_members_from_group(group_name):
-    members = get_users_in_group(group_name)
-    for member in members:
-        remove_member_from_group(group_name, member['objectId'])
+    index = GroupMembershipIndex()
+    return remove_group_members(group_name, list(index.get(group_name)), index)
 
 
 def get_group(group_name):
@@ -92,7 +204,75 @@ def get_group(group_name):
     return _run(command)
 
 
+def lookup_groups(names, jobs=8, cache=None):
+    """
+    get_group for each name not in cache ({name: group, or None if not found}) using jobs workers, so a group used in
+    many places is only looked up once. Returns the (updated) cache
+    """
+    def lookup(name):
+        try:
+            return get_group(name)
+        except subprocess.CalledProcessError:
+            return None
+
+    cache = {} if cache is None else cache
+    missing = [name for name in set(names) if name not in cache]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        cache.update(zip(missing, executor.map(lookup, missing)))
+    return cache
+
+
 def copy_members(from_group, to_group):
-    members = get_users_in_group(from_group)
-    for member in members:
-        add_group_member(to_group, member['objectId'])
+    """
+    Add the members of from_group missing in to_group, returns {object_id: outcome} (see add_group_members)
+    """
+    index = GroupMembershipIndex()
+    missing = index.get(from_group) - index.get(to_group)
+    return add_group_members(to_group, list(missing), index)
+
+
+class GroupMembershipIndex(object):
+    """
+    The (direct) member objectIds of each group, listed once per group instead of calling user_in_group, which lists all
+    groups of the user, before every mutation. Members added or removed through the index are kept up to date.
+    """
+    def __init__(self):
+        self.members = {}
+
+    def get(self, group_name):
+        if group_name not in self.members:
+            self.members[group_name] = set(iter_member_ids(group_name))
+        return self.members[group_name]
+
+    def contains(self, group_name, object_id):
+        return object_id in self.get(group_name)
+
+    def add(self, group_name, object_id):
+        """Add object_id to the group unless already a member, returns True if it was added"""
+        if self.contains(group_name, object_id):
+            return False
+
+        _add_member(group_name, object_id)
+        self.members[group_name].add(object_id)
+        return True
+
+    def remove(self, group_name, object_id):
+        """Remove object_id from the group if a member, returns True if it was removed"""
+        if not self.contains(group_name, object_id):
+            return False
+
+        _remove_member(group_name, object_id)
+        self.members[group_name].discard(object_id)
+        return True
+
+    def refresh(self, group_name=None):
+        """Forget the members of group_name (all groups if None), e.g. after changes made outside the index"""
+        if group_name is None:
+            self.members.clear()
+        else:
+            self.members.pop(group_name, None)
+
+
+if os.environ.get('AZURE_WRAPPER_BACKEND') == 'graph':
+    # Replaces the az cli functions above, remove_members_from_group and copy_members then use the Graph API too
+    from graph_wrapper import *  # noqa: E402,F401,F403
@@ -1,46 +1,56 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 from datetime import datetime
 import requests
+from requests.adapters import HTTPAdapter
 
 
 class Bitbucket(object):
     # https://docs.atlassian.com/bitbucket-server/rest/6.7.0/bitbucket-rest.html
 
-    def __init__(self, host, auth):
+    def __init__(self, host, auth, page_size=1000, pool_size=8):
         self.base_url = 'https://{host}/rest/api/1.0'.format(host=host)
         self.auth = auth
+        self.page_size = page_size
+        # Keep-alive connections shared by all requests (and threads)
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=pool_size))
 
     def get_users(self):
-        url = '{base}/admin/users?limit=1000'.format(base=self.base_url)
-        request = requests.get(url, auth=self.auth)
-        request.raise_for_status()
-        return request.json()['values']
+        return self._paginate('/admin/users')
 
     def get_groups(self):
-        url = '{base}/admin/groups?limit=1000'.format(base=self.base_url)
-        request = requests.get(url, auth=self.auth)
-        request.raise_for_status()
-        return request.json()['values']
+        return self._paginate('/admin/groups')
 
     def get_projects(self):
-        url = '{base}/projects?limit=1000'.format(base=self.base_url)
-        request = requests.get(url, auth=self.auth)
-        request.raise_for_status()
-        return request.json()['values']
+        return self._paginate('/projects')
 
     def get_project_group_permissions(self, key):
-        url = '{base}/projects/{key}/permissions/groups?limit=1000'.format(base=self.base_url, key=key)
-        request = requests.get(url, auth=self.auth)
-        request.raise_for_status()
-        return request.json()['values']
+        return list(self._paginate('/projects/{key}/permissions/groups'.format(key=key)))
+
+    def _paginate(self, path):
+        """
+        Generator yielding the values of every page, requesting pages until isLastPage
+        """
+        url = '{base}{path}'.format(base=self.base_url, path=path)
+        start = 0
+        while True:
+            request = self.session.get(url, params={'start': start, 'limit': self.page_size})
+            request.raise_for_status()
+            page = request.json()
+            yield from page['values']
+            if page.get('isLastPage', True):
+                return
+            start = page['nextPageStart']
 
     def get_users_not_logged_in_for_90_days(self):
         today = datetime.now()
 
-        users = self.get_users()
-        filtered = [u for u in users if self._not_logged_in_for_90_days(u, today)]
+        # Users are filtered page by page, only the inactive ones are kept (and sorted)
+        filtered = (u for u in self.get_users() if self._not_logged_in_for_90_days(u, today))
         return sorted(filtered, key=lambda u: u['lastAuthenticationDate'])
 
     @staticmethod
@@ -65,18 +75,21 @@ def display_groups(bitbucket):
         print(group['name'])
 
 
-def display_project_permissions(bitbucket):
-    for project in bitbucket.get_projects():
-        group_perms = bitbucket.get_project_group_permissions(project['key'])
-        if len(group_perms) > 0:
-            print("project = {key}".format(key=project['key']))
-            for group_perm in group_perms:
-                print("  {name} - {item}".format(name=group_perm['group']['name'], item=group_perm['permission']))
+def display_project_permissions(bitbucket, jobs=8):
+    # Permissions of up to jobs projects are fetched concurrently, output stays in project order
+    projects = bitbucket.get_projects()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        fetches = executor.map(lambda p: (p, bitbucket.get_project_group_permissions(p['key'])), projects)
+        for (project, group_perms) in fetches:
+            if len(group_perms) > 0:
+                print("project = {key}".format(key=project['key']))
+                for group_perm in group_perms:
+                    print("  {name} - {item}".format(name=group_perm['group']['name'], item=group_perm['permission']))
 
 
-def main(bitbucket):
+def main(bitbucket, jobs=8):
     # display_users_not_logged_in_for_90_days(bitbucket)
-    display_project_permissions(bitbucket)
+    display_project_permissions(bitbucket, jobs)
 
 
 if __name__ == '__main__':
@@ -84,7 +97,8 @@ if __name__ == '__main__':
     parser.add_argument('--host', required=True)
     parser.add_argument('--user', default='admin')
     parser.add_argument('--password', required=True)
+    parser.add_argument('--jobs', type=int, default=8, help="Concurrent Bitbucket requests")
 
     args = parser.parse_args()
-    bitbucket = Bitbucket(args.host, (args.user, args.password))
-    main(bitbucket)
+    bitbucket = Bitbucket(args.host, (args.user, args.password), pool_size=args.jobs)
+    main(bitbucket, args.jobs)
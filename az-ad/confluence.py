@@ -1,29 +1,60 @@
 #!/usr/bin/env python3
 
 import argparse
-import subprocess
+import concurrent.futures
 
 import requests
+from requests.adapters import HTTPAdapter
 
 import azure_wrapper
 
+IGNORED_GROUPS = ['confluence-users', 'confluence-administrators', 'jira-software-users', 'jira-administrators']
+
 
 class Confluence(object):
     # https://<host>/rest/api/group/confluence-administrators/member?expand=status
 
-    def __init__(self, host, auth) -> None:
-        self.base_url = 'https://{host}/rest/api'.format(host=host)
+    def __init__(self, host, auth, page_size=200, pool_size=8) -> None:
+        self.host_url = 'https://{host}'.format(host=host)
+        self.base_url = '{host_url}/rest/api'.format(host_url=self.host_url)
         self.auth = auth
+        self.page_size = page_size
+        # Keep-alive connections shared by all requests (and threads)
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=pool_size))
 
     def get_members_in_group(self, group):
-        return self._json_request('/group/{group}/member?expand=status'.format(group=group))
+        return {'results': list(self.iter_members_in_group(group))}
 
     def get_groups(self):
-        return self._json_request('/group')
-
-    def _json_request(self, relative_url):
-        url = "{base_url}{relative_url}".format(base_url=self.base_url, relative_url=relative_url)
-        request = requests.get(url, auth=self.auth)
+        return {'results': list(self.iter_groups())}
+
+    def iter_members_in_group(self, group):
+        return self._paginate('/group/{group}/member?expand=status'.format(group=group))
+
+    def iter_groups(self):
+        return self._paginate('/group')
+
+    def _paginate(self, relative_url):
+        """
+        Yields the results of every page, following _links.next until the last page
+        """
+        separator = '&' if '?' in relative_url else '?'
+        url = "{base_url}{relative_url}{separator}limit={limit}".format(
+            base_url=self.base_url, relative_url=relative_url, separator=separator, limit=self.page_size
+        )
+        while url:
+            page = self._get(url)
+            yield from page['results']
+
+            links = page.get('_links', {})
+            url = None
+            if 'next' in links:
+                url = '{base}{next}'.format(base=links.get('base', self.host_url), next=links['next'])
+
+    def _get(self, url):
+        request = self.session.get(url)
         request.raise_for_status()
         return request.json()
 
@@ -37,51 +68,76 @@ class Confluence(object):
         return filtered
 
 
+def _quote(value):
+    return value.replace("'", "''")
+
+
+def rename_groups_sql(renames):
+    """
+    One script renaming all groups (permissions AND group names), renames being [(old group, new group)]. The renames
+    are loaded into a mapping table so each table is updated once for all groups.
+    The mapping table is created before and dropped after the transaction, as DDL commits implicitly on MySQL
+    """
+    values = ',\n'.join("  ('{old}', '{new}', '{new_lower}')".format(
+        old=_quote(old), new=_quote(new), new_lower=_quote(new.lower())) for (old, new) in renames
+    )
+    # lower_group_name is assigned first and from its own column: MySQL applies SET assignments left to right, so a
+    # lookup on group_name after group_name has been renamed would find nothing
+    return """CREATE TABLE group_rename (
+  old_group VARCHAR(255) PRIMARY KEY, new_group VARCHAR(255) NOT NULL, new_group_lower VARCHAR(255) NOT NULL
+);
+BEGIN;
+INSERT INTO group_rename (old_group, new_group, new_group_lower) VALUES
+{values};
+UPDATE spacepermissions SET permgroupname = (SELECT new_group FROM group_rename WHERE old_group = permgroupname)
+WHERE permgroupname IN (SELECT old_group FROM group_rename);
+UPDATE content_perm SET groupname = (SELECT new_group FROM group_rename WHERE old_group = groupname)
+WHERE groupname IN (SELECT old_group FROM group_rename);
+UPDATE cwd_group SET lower_group_name = (SELECT new_group_lower FROM group_rename WHERE old_group = group_name),
+group_name = (SELECT new_group FROM group_rename WHERE old_group = group_name)
+WHERE group_name IN (SELECT old_group FROM group_rename);
+COMMIT;
+DROP TABLE group_rename;""".format(values=values)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', required=True)
     parser.add_argument('--user', default='admin')
     parser.add_argument('--password', required=True)
+    parser.add_argument('--jobs', type=int, default=8, help="Concurrent Confluence requests and group lookups")
 
     args = parser.parse_args()
-    confluence = Confluence(args.host, (args.user, args.password))
-
-    groups = confluence.get_groups()
-    for group in groups['results']:
-        name = group['name']
-
-        if name in ['confluence-users', 'confluence-administrators', 'jira-software-users', 'jira-administrators']:
-            print("-- Ignored group: {name}".format(name=name))
-            continue
-
-        result = confluence.get_members_in_group(name)
-
+    confluence = Confluence(args.host, (args.user, args.password), pool_size=args.jobs)
+
+    names = []
+    for group in confluence.iter_groups():
+        if group['name'] in IGNORED_GROUPS:
+            print("-- Ignored group: {name}".format(name=group['name']))
+        else:
+            names.append(group['name'])
+
+    # Member counts and Azure AD groups are fetched concurrently, each group is looked up in Azure AD once
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        counts = executor.map(lambda name: sum(1 for _ in confluence.iter_members_in_group(name)), names)
+        groups = azure_wrapper.lookup_groups(names, args.jobs)
+        member_counts = dict(zip(names, counts))
+
+    renames = []
+    for name in names:
         # Use this to display all groups with member counts
-        # print('{name} - {count}'.format(name=name, count=len(result['results'])))
+        # print('{name} - {count}'.format(name=name, count=member_counts[name]))
         # continue
 
-        try:
-            group_info = azure_wrapper.get_group(name)
-        except subprocess.CalledProcessError:
-            group_info = None
-
+        group_info = groups[name]
         if group_info:
-            old_group = name
-            new_group = group_info['displayName']
-
-            # SQL to update permissions AND group names
-            rename_group_sql = """UPDATE spacepermissions SET permgroupname = '{new_group}' 
-            WHERE permgroupname = '{old_group}';
-            UPDATE content_perm SET groupname = '{new_group}' 
-            WHERE groupname IN ('old_group');
-            UPDATE cwd_group SET group_name = '{new_group}', lower_group_name = '{new_group_lower}' 
-            WHERE group_name = '{old_group}';""".format(
-                new_group=new_group, old_group=old_group, new_group_lower=new_group.lower()
-            ).strip()
-
-            # This outputs SQL to stdout, should be captured in a file and then run
-            print('-- {group} -> {name}'.format(group=old_group, name=new_group))
-            print(rename_group_sql)
+            renames.append((name, group_info['displayName']))
+            print('-- {group} -> {name} ({count} members)'.format(
+                group=name, name=group_info['displayName'], count=member_counts[name])
+            )
 
-    # print(json.dumps(confluence.get_active_users_from_result(result), indent=4, separators=(',', ': ')))
+    # This outputs SQL to stdout, should be captured in a file and then run
+    if renames:
+        print(rename_groups_sql(renames))
 
+    # print(json.dumps(confluence.get_active_users_from_result(result), indent=4, separators=(',', ': ')))
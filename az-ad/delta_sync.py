@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+
+import requests
+
+"""
+Incremental sync of users and groups using Graph delta queries (/users/delta, /groups/delta). The objects are kept in a
+local snapshot file along with the @odata.deltaLink, so later runs only fetch what changed since the previous run.
+
+E.g. ./delta_sync.py --users users.json --groups groups.json
+
+"""
+
+USER_FIELDS = 'displayName,mail,userPrincipalName,userType'
+# Selecting members makes group changes include members@delta (added and removed members)
+GROUP_FIELDS = 'displayName,mail,members'
+
+
+class DeltaSnapshot(object):
+    """
+    Local copy of all users or groups (resource) with the fields in select, kept in sync using delta queries.
+    The first sync reads everything, later syncs apply the changes since the deltaLink stored in the snapshot file.
+    Groups keep their member ids in 'members'.
+    """
+    def __init__(self, path, resource, select):
+        self.path = path
+        self.resource = resource
+        self.select = select
+        self.delta_link = None
+        self.objects = {}
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path) as f:
+            data = json.load(f)
+
+        # A snapshot of other fields can't be updated using deltas, start over instead
+        if data.get('resource') == self.resource and data.get('select') == self.select:
+            self.delta_link = data['deltaLink']
+            self.objects = data['objects']
+
+    def save(self):
+        data = {'resource': self.resource, 'select': self.select, 'deltaLink': self.delta_link, 'objects': self.objects}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def values(self):
+        return list(self.objects.values())
+
+    def sync(self, graph):
+        """
+        Apply the changes since the last sync (everything on the first sync), returns the number of changes applied
+        """
+        try:
+            return self._sync(graph)
+        except requests.HTTPError as e:
+            if self.delta_link is None or e.response is None or e.response.status_code != 410:
+                raise
+
+            # The deltaLink has expired, a full sync is required
+            self.delta_link = None
+            self.objects = {}
+            return self._sync(graph)
+
+    def _sync(self, graph):
+        if self.delta_link:
+            pages = graph.iter_pages(url=self.delta_link)
+        else:
+            pages = graph.iter_pages('/{resource}/delta?$select={select}'.format(
+                resource=self.resource, select=self.select)
+            )
+
+        changes = 0
+        delta_link = None
+        for page in pages:
+            for directory_object in page['value']:
+                self._apply(directory_object)
+                changes += 1
+            delta_link = page.get('@odata.deltaLink')
+
+        self.delta_link = delta_link
+        self.save()
+        return changes
+
+    def _apply(self, directory_object):
+        if '@removed' in directory_object:
+            self.objects.pop(directory_object['id'], None)
+            return
+
+        # Changed objects may only include the changed fields
+        members = directory_object.pop('members@delta', None)
+        current = self.objects.setdefault(directory_object['id'], {})
+        current.update(directory_object)
+        if members is not None:
+            member_ids = set(current.get('members', []))
+            for member in members:
+                if '@removed' in member:
+                    member_ids.discard(member['id'])
+                else:
+                    member_ids.add(member['id'])
+            current['members'] = sorted(member_ids)
+
+
+if __name__ == '__main__':
+    import graph
+    import graph_config
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', metavar='FILE', help="Users snapshot file")
+    parser.add_argument('--groups', metavar='FILE', help="Groups snapshot file")
+    args = parser.parse_args()
+
+    client = graph.Graph(graph_config)
+    for (path, resource, select) in [(args.users, 'users', USER_FIELDS), (args.groups, 'groups', GROUP_FIELDS)]:
+        if path:
+            snapshot = DeltaSnapshot(path, resource, select)
+            changes = snapshot.sync(client)
+            print("{resource}: {changes} changes, {count} in total".format(
+                resource=resource, changes=changes, count=len(snapshot.objects))
+            )
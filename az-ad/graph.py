@@ -1,12 +1,25 @@
 #!/usr/bin/env python3 -u
 
-import adal
 import argparse
+import concurrent.futures
 import logging
+import random
 import requests
+import sys
+import threading
 import time
 
+import delta_sync
 import graph_config
+import token_provider
+
+# Max sub-requests in one JSON batch request
+BATCH_SIZE = 20
+# Default number of batch requests sent concurrently
+BATCHES_IN_FLIGHT = 4
+# Retries of a throttled request, waiting as told by Retry-After or backing off exponentially up to MAX_BACKOFF seconds
+MAX_RETRIES = 8
+MAX_BACKOFF = 120
 
 
 # TODO: Document app registration required, including permissions
@@ -17,23 +30,23 @@ class Graph(object):
     Main focus right now is to exract users and their last login details (auditing)
     """
 
-    def __init__(self, config):
-        self._initialize(config)
+    def __init__(self, config, tokens=None):
+        """
+        tokens: TokenProvider, by default one caching tokens on disk (see token_provider)
+        """
+        self.tokens = tokens or token_provider.TokenProvider(config)
         self.headers = {
-            'Authorization': 'Bearer {token}'.format(token=self.token["accessToken"]),
             'Accept': 'application/json',
             'Content-Type': 'application/json'
         }
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
         self._remote = '{config.API_BASE}/{config.API_VERSION}{{endpoint}}'.format(config=config)
+        self.stats = {'requests': 0, 'pages': 0, 'bytes': 0, 'throttled': 0, 'throttled_seconds': 0.0}
+        self.stats_lock = threading.Lock()
         self.logger = logging.getLogger("graph")
         self.logger.setLevel(logging.ERROR)
 
-    def _initialize(self, config):
-        self.context = adal.AuthenticationContext(config.GRAPH_AUTHORITY)
-        self.token = self.context.acquire_token_with_client_credentials(
-            config.API_BASE, config.CLIENT_ID, config.CLIENT_SECRET
-        )
-
     def get_guest_users(self) -> []:
         return self._query_for_values("/users?$filter=userType eq 'Guest'&$select=displayName,mail,id,userPrincipalName")
 
@@ -41,37 +54,183 @@ class Graph(object):
         result = self._query(endpoint="/auditLogs/signIns?$filter=userId eq '{user_id}'&$top=1".format(user_id=user_id))
         return result['value'][0] if len(result['value']) == 1 else None
 
+    def get_most_recent_sign_ins(self, user_ids):
+        """
+        Same as get_most_recent_sign_in for many users using batch requests, yields the results in the order of user_ids
+        """
+        batch_requests = [{
+            'method': 'GET',
+            'url': "/auditLogs/signIns?$filter=userId eq '{user_id}'&$top=1".format(user_id=user_id)
+        } for user_id in user_ids]
+
+        for (user_id, response) in zip(user_ids, self.batch(batch_requests)):
+            if response['status'] >= 400:
+                raise requests.HTTPError("{status} getting sign-ins of {user_id}: {body}".format(
+                    status=response['status'], user_id=user_id, body=response.get('body'))
+                )
+            values = response['body']['value']
+            yield values[0] if len(values) == 1 else None
+
     def get_sign_ins(self):
+        """
+        Generator, sign-ins are yielded page by page as they arrive (there may be millions of them)
+        """
         # Filter example for createDateTime:
         # endpoint="/auditLogs/signIns?$filter=userId eq 'object_id' and createdDateTime le 2019-09-01")
-        return self._query_for_values(endpoint='/auditLogs/signIns')
+        return self._iter_values(endpoint='/auditLogs/signIns', prefetch=True)
+
+    def get(self, endpoint, params=None):
+        """
+        params: query parameters (e.g. {'$filter': ...}), url encoded by requests
+        """
+        return self._query(endpoint=endpoint, params=params)
+
+    def get_values(self, endpoint, params=None):
+        return self._query_for_values(endpoint, params)
+
+    def iter_values(self, endpoint, prefetch=False, params=None):
+        return self._iter_values(endpoint, prefetch, params)
+
+    def iter_pages(self, endpoint=None, url=None, prefetch=False):
+        return self._iter_pages(endpoint, url, prefetch)
+
+    def post(self, endpoint, data):
+        return self._request('POST', endpoint=endpoint, data=data)
+
+    def patch(self, endpoint, data):
+        return self._request('PATCH', endpoint=endpoint, data=data)
+
+    def delete(self, endpoint):
+        return self._request('DELETE', endpoint=endpoint)
+
+    def batch(self, batch_requests, max_in_flight=BATCHES_IN_FLIGHT):
+        """
+        Send batch_requests ({method, url, body}, with url relative to the API version) using JSON batching, up to
+        BATCH_SIZE per request and max_in_flight requests at a time.
+        Yields the responses ({id, status, headers, body}) in the order of batch_requests
+        """
+        chunks = []
+        for i in range(0, len(batch_requests), BATCH_SIZE):
+            chunk = []
+            for (n, request) in enumerate(batch_requests[i:i + BATCH_SIZE]):
+                request = dict(request, id=str(n))
+                if 'body' in request:
+                    request['headers'] = {'Content-Type': 'application/json'}
+                chunk.append(request)
+            chunks.append(chunk)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            for responses in executor.map(self._send_batch, chunks):
+                yield from responses
 
-    def _query_for_values(self, endpoint):
-        query_result = self._query(endpoint=endpoint)
-        result = []
+    def _send_batch(self, chunk, max_retries=5):
+        """
+        Send one batch, throttled sub-requests are sent again (in a new batch) once their own Retry-After has passed
+        """
+        requests_by_id = {request['id']: request for request in chunk}
+        pending = {request['id']: (0, 0) for request in chunk}  # id -> (attempt, not before)
+        responses = {}
+        while pending:
+            now = time.time()
+            due = [request_id for (request_id, (_, not_before)) in pending.items() if not_before <= now]
+            if not due:
+                wait = min(not_before for (_, not_before) in pending.values()) - now
+                self._count(throttled_seconds=wait)
+                time.sleep(wait)
+                continue
+
+            result = self._request('POST', endpoint='/$batch', data={
+                'requests': [requests_by_id[request_id] for request_id in due]
+            }).json()
+            for response in result['responses']:
+                attempt = pending[response['id']][0]
+                if response['status'] == 429 and attempt < max_retries:
+                    headers = {k.lower(): v for (k, v) in (response.get('headers') or {}).items()}
+                    wait = float(headers.get('retry-after', 2 ** attempt))
+                    self.logger.debug("Sub-request throttled, retrying in %s seconds", wait)
+                    self._count(throttled=1)
+                    pending[response['id']] = (attempt + 1, time.time() + wait)
+                else:
+                    responses[response['id']] = response
+                    del pending[response['id']]
+
+        return [responses[request['id']] for request in chunk]
+
+    def _query_for_values(self, endpoint, params=None):
         # Retrieves ALL results, which my be paginated
-        while '@odata.nextLink' in query_result:
-            result.extend(query_result['value'])
-            self.logger.debug("Paging, fetching next page")
-            query_result = self._query(url=query_result['@odata.nextLink'])
-        # Add last result to values (the result which is not paginated)
-        result.extend(query_result['value'])
-        return result
-
-    def _query(self, endpoint=None, url=None):
+        return list(self._iter_values(endpoint, params=params))
+
+    def _iter_values(self, endpoint, prefetch=False, params=None):
+        """
+        Yields the values of every page, following @odata.nextLink. With prefetch the next page is requested while the
+        values of the current page are being consumed
+        """
+        for page in self._iter_pages(endpoint, prefetch=prefetch, params=params):
+            yield from page['value']
+
+    def _iter_pages(self, endpoint=None, url=None, prefetch=False, params=None):
+        """
+        Yields every page (the whole response, e.g. to get the @odata.deltaLink of the last page), see _iter_values
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            # @odata.nextLink already includes the (encoded) query parameters
+            page = self._query(endpoint=endpoint, url=url, params=params)
+            while True:
+                self._count(pages=1)
+                next_link = page.get('@odata.nextLink')
+                next_page = executor.submit(self._query, url=next_link) if prefetch and next_link else None
+                yield page
+                if not next_link:
+                    return
+
+                self.logger.debug("Paging, fetching next page")
+                page = next_page.result() if next_page else self._query(url=next_link)
+
+    def _query(self, endpoint=None, url=None, params=None):
+        return self._request('GET', endpoint=endpoint, url=url, params=params).json()
+
+    def _request(self, method, endpoint=None, url=None, data=None, params=None):
         if url:
             request_url = url
         else:
             request_url = self._remote.format(endpoint=endpoint)
 
-        response = requests.get(url=request_url, headers=self.headers)
-        if response.status_code == 429:
-            # We're throttled! Wait before retrying
-            self.logger.debug("Throttled, waiting...")
-            time.sleep(10)
-            return self._query(url=request_url)
+        attempt = 0
+        refreshed = False
+        while True:
+            # One keep-alive session for all requests, instead of a new connection (and TLS handshake) per request
+            headers = {'Authorization': 'Bearer {token}'.format(token=self.tokens.token())}
+            response = self.session.request(method, url=request_url, json=data, params=params, headers=headers)
+            self._count(requests=1, bytes=len(response.content))
+            if response.status_code == 401 and not refreshed:
+                # The token expired or was revoked before we expected, retry once with a new token
+                self.logger.debug("Unauthorized, refreshing token")
+                self.tokens.token(force_refresh=True)
+                refreshed = True
+                continue
+
+            if response.status_code not in (429, 503, 504) or attempt >= MAX_RETRIES:
+                break
+
+            # We're throttled! Wait as told, or back off exponentially with jitter so threads don't retry in lockstep
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                wait = int(retry_after)
+            else:
+                backoff = min(MAX_BACKOFF, 2 ** attempt)
+                wait = backoff / 2 + random.uniform(0, backoff / 2)
+            self.logger.debug("Throttled, waiting %s seconds...", wait)
+            self._count(throttled=1, throttled_seconds=wait)
+            time.sleep(wait)
+            attempt += 1
+
         response.raise_for_status()
-        return response.json()
+        return response
+
+    def _count(self, **counters):
+        with self.stats_lock:
+            for (name, value) in counters.items():
+                self.stats[name] += value
 
 
 def main(args):
@@ -81,10 +240,19 @@ def main(args):
     graph = Graph(graph_config)
     count = 0
 
-    for user in sorted(graph.get_guest_users(), key=lambda u: u['mail']):
+    if args.delta_snapshot:
+        # Only users changed since the previous run are fetched
+        snapshot = delta_sync.DeltaSnapshot(args.delta_snapshot, 'users', delta_sync.USER_FIELDS)
+        snapshot.sync(graph)
+        guests = [u for u in snapshot.values() if u.get('userType') == 'Guest']
+    else:
+        guests = graph.get_guest_users()
+
+    users = sorted(guests, key=lambda u: u['mail'] or '')
+    # Sign-ins are fetched in concurrent batches, but yielded in the order of users
+    for (user, sign_in) in zip(users, graph.get_most_recent_sign_ins([u['id'] for u in users])):
         # user has {displayName, mail, id, userPrincipalName}
         # sign_in is None or has {createdDateTime}
-        sign_in = graph.get_most_recent_sign_in(user['id'])
         display_user = not sign_in if args.no_logins else True
         if display_user:
             count += 1
@@ -95,6 +263,9 @@ def main(args):
                 date=sign_in_date)
             )
     print("Matched {count} user(s) in total".format(count=count))
+    if args.stats:
+        print("{requests} requests, {pages} pages, {bytes} bytes received, {throttled} throttled "
+              "({throttled_seconds:.1f}s waiting)".format(**graph.stats), file=sys.stderr)
 
 
 if __name__ == '__main__':
@@ -102,6 +273,10 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--no-logins", action="store_true", default=False, help="Only output users without any login")
+    parser.add_argument("--delta-snapshot", metavar='FILE',
+                        help="Keep all users in FILE, synced using delta queries, instead of listing guests every run")
+    parser.add_argument("--stats", action="store_true", default=False,
+                        help="Output request, page, byte and throttling counters to stderr")
     args = parser.parse_args()
 
     main(args)
@@ -0,0 +1,213 @@
+import re
+import threading
+
+import requests
+
+import graph
+import graph_config
+
+"""
+Microsoft Graph API implementation of the azure_wrapper functions, used by azure_wrapper when
+AZURE_WRAPPER_BACKEND=graph. All calls share one Graph client (one keep-alive session and one token per process)
+instead of starting an az cli process per call. Results are normalized to look like the az cli output (objectId,
+objectType), so the scripts work unchanged with either backend.
+
+"""
+
+# add_group_member, remove_member_from_group and GroupMembershipIndex in azure_wrapper use _add_member/_remove_member
+__all__ = [
+    'filter_users', 'find_user_by_email', 'get_member_groups', 'user_in_group', 'get_users_in_group',
+    'iter_member_ids', 'get_group',
+    '_add_member', '_remove_member', '_add_members', '_remove_members',
+]
+
+# Max members added with one members@odata.bind request
+MEMBERS_PER_PATCH = 20
+
+USER_FIELDS = 'id,displayName,mail,userPrincipalName,userType'
+GROUP_FIELDS = 'id,displayName,mail,description'
+
+_guid = re.compile('^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.IGNORECASE)
+_client = None
+_client_lock = threading.Lock()
+_group_ids = {}
+
+
+# Internal helper methods #
+def _graph():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = graph.Graph(graph_config)
+    return _client
+
+
+def _normalize(directory_object, object_type):
+    """
+    Add the az cli fields objectId and objectType (User, Group...) to a Graph directory object
+    """
+    odata_type = directory_object.get('@odata.type', '#microsoft.graph.{type}'.format(type=object_type))
+    name = odata_type.rsplit('.', 1)[-1]
+    directory_object['objectId'] = directory_object['id']
+    directory_object['objectType'] = name[:1].upper() + name[1:]
+    return directory_object
+
+
+def _quote(value):
+    return value.replace("'", "''")
+
+
+def _group_id(group_name):
+    """
+    Id of a group given its display name or id, looked up once per process
+    """
+    if group_name not in _group_ids:
+        group = get_group(group_name)
+        if group is None:
+            raise ValueError("Group {group} not found".format(group=group_name))
+        _group_ids[group_name] = group['objectId']
+
+    return _group_ids[group_name]
+
+
+def _directory_object_url(object_id):
+    return '{config.API_BASE}/{config.API_VERSION}/directoryObjects/{id}'.format(config=graph_config, id=object_id)
+# End internal helper methods #
+
+
+# User centric functions #
+def filter_users(search_filter):
+    """
+    Example filter: "mail eq 'robert.dahlstrom@diabol.se'"
+    See https://docs.microsoft.com/en-us/graph/query-parameters#filter-parameter
+    """
+    params = {'$filter': search_filter, '$select': USER_FIELDS}
+    return [_normalize(user, 'user') for user in _graph().get_values('/users', params)]
+
+
+def find_user_by_email(email):
+    """
+    Search for a user by email and returns User if found, or None if no user was found
+    """
+    result = filter_users("mail eq '{mail}'".format(mail=_quote(email)))
+
+    if len(result) == 1:
+        return result[0]
+
+    return None
+
+
+def get_member_groups(object_id):
+    """
+    All groups the user is a member of, directly or through nested groups (like az ad user get-member-groups)
+    """
+    endpoint = '/users/{id}/transitiveMemberOf/microsoft.graph.group?$select=id,displayName'.format(id=object_id)
+    return [_normalize(group, 'group') for group in _graph().get_values(endpoint)]
+
+
+# Group centric functions #
+def _add_member(group_name, object_id):
+    endpoint = '/groups/{id}/members/$ref'.format(id=_group_id(group_name))
+    _graph().post(endpoint, {'@odata.id': _directory_object_url(object_id)})
+
+
+def user_in_group(object_id, group_name):
+    """
+    Checks (transitive) membership of one group with a single request instead of listing all the user's groups
+    """
+    group_id = _group_id(group_name)
+    endpoint = '/directoryObjects/{id}/checkMemberGroups'.format(id=object_id)
+    return group_id in _graph().post(endpoint, {'groupIds': [group_id]}).json()['value']
+
+
+def get_users_in_group(group_name):
+    endpoint = '/groups/{id}/members?$select={fields}'.format(id=_group_id(group_name), fields=USER_FIELDS)
+    return [_normalize(member, 'user') for member in _graph().get_values(endpoint)]
+
+
+def iter_member_ids(group_name):
+    """
+    Yields the member ids page by page, only requesting the id of each member
+    """
+    endpoint = '/groups/{id}/members?$select=id'.format(id=_group_id(group_name))
+    for member in _graph().iter_values(endpoint, prefetch=True):
+        yield member['id']
+
+
+def _remove_member(group_name, object_id):
+    endpoint = '/groups/{id}/members/{member_id}/$ref'.format(id=_group_id(group_name), member_id=object_id)
+    _graph().delete(endpoint)
+
+
+def _add_members(group_name, object_ids):
+    """
+    Adds MEMBERS_PER_PATCH members per request using members@odata.bind. The request fails as a whole when one member
+    can't be added (e.g. already a member), the members of a failed request are then added one at a time.
+    Returns {object_id: None if added, or the error}
+    """
+    group_id = _group_id(group_name)
+    errors = {}
+    for i in range(0, len(object_ids), MEMBERS_PER_PATCH):
+        chunk = object_ids[i:i + MEMBERS_PER_PATCH]
+        try:
+            _graph().patch('/groups/{id}'.format(id=group_id), {
+                'members@odata.bind': [_directory_object_url(object_id) for object_id in chunk]
+            })
+            errors.update(dict.fromkeys(chunk))
+        except requests.HTTPError:
+            for object_id in chunk:
+                try:
+                    _add_member(group_name, object_id)
+                    errors[object_id] = None
+                except requests.HTTPError as e:
+                    errors[object_id] = e
+    return errors
+
+
+def _remove_members(group_name, object_ids):
+    """
+    Removes members using JSON batching, failed (or throttled) removals are retried one at a time.
+    Returns {object_id: None if removed, or the error}
+    """
+    group_id = _group_id(group_name)
+    batch_requests = [{
+        'method': 'DELETE',
+        'url': '/groups/{id}/members/{member_id}/$ref'.format(id=group_id, member_id=object_id)
+    } for object_id in object_ids]
+
+    errors = {}
+    for (object_id, response) in zip(object_ids, _graph().batch(batch_requests)):
+        if response['status'] < 400:
+            errors[object_id] = None
+            continue
+
+        try:
+            _remove_member(group_name, object_id)
+            errors[object_id] = None
+        except requests.HTTPError as e:
+            errors[object_id] = e
+    return errors
+
+
+def get_group(group_name):
+    """
+    Group by display name or id, None if there is no such group (az ad group show fails instead)
+    """
+    if _guid.match(group_name):
+        try:
+            group = _graph().get('/groups/{id}?$select={fields}'.format(id=group_name, fields=GROUP_FIELDS))
+        except requests.HTTPError as e:
+            if e.response.status_code == 404:
+                return None
+            raise
+        return _normalize(group, 'group')
+
+    # Passed as params so names like R&D or a#b are url encoded
+    params = {'$filter': "displayName eq '{name}'".format(name=_quote(group_name)), '$select': GROUP_FIELDS}
+    groups = _graph().get_values('/groups', params)
+    if len(groups) > 1:
+        raise ValueError("{count} groups named {name}, use the group id instead".format(
+            count=len(groups), name=group_name)
+        )
+
+    return _normalize(groups[0], 'group') if groups else None
@@ -1,18 +1,27 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import json
 import re
-import subprocess
 
 import requests
+from requests.adapters import HTTPAdapter
 
 import azure_wrapper
 
+# Actors named like an Azure AD group objectId
+ACTOR_PATTERN = re.compile('[a-f0-9]+-[a-f0-9]+.*')
+
+
 class JIRA(object):
-    def __init__(self, host, auth) -> None:
+    def __init__(self, host, auth, pool_size=8) -> None:
         self.base_url = 'https://{host}/rest/api/2'.format(host=host)
         self.auth = auth
+        # Keep-alive connections shared by all requests (and threads)
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=pool_size))
 
     def user_search(self, search, max_results=1000):
         url = '/user/search?username={search}&maxResults={max_results}'.format(search=search, max_results=max_results)
@@ -31,13 +40,13 @@ class JIRA(object):
 
     def _query(self, url):
         query_url = '{base_url}{url}'.format(base_url=self.base_url, url=url)
-        request = requests.get(query_url, auth=self.auth)
+        request = self.session.get(query_url)
         request.raise_for_status()
         return request.json()
 
     def _update(self, url, data):
         post_url = '{base_url}{url}'.format(base_url=self.base_url, url=url)
-        request = requests.post(post_url, json=data)
+        request = self.session.post(post_url, json=data)
         request.raise_for_status()
         return request.json()
 
@@ -46,39 +55,79 @@ class JIRA(object):
         return self._update(url, actor_to_add)
 
 
+def crawl(jira, jobs):
+    """
+    {project key: (project, [role details])} for all projects, the roles of all projects are fetched by jobs workers
+    """
+    projects = jira.get_projects()
+    result = {project['key']: (project, []) for project in projects}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        project_roles = executor.map(lambda project: jira.get_project_roles(project['id']), projects)
+        role_urls = [(project['key'], url)
+                     for (project, roles) in zip(projects, project_roles) for url in roles.values()]
+        for ((key, _), role_details) in zip(role_urls, executor.map(lambda x: jira.query(x[1]), role_urls)):
+            result[key][1].append(role_details)
+    return result
+
+
+def update_plan(projects, groups):
+    """
+    One update per project role: the Azure AD groups to assign for its actors named like a group objectId, skipping
+    groups already assigned
+    """
+    plan = []
+    for (key, (project, roles)) in sorted(projects.items()):
+        for role_details in roles:
+            assigned = {actor['name'] for actor in role_details['actors']}
+            to_add = [groups[actor['name']]['displayName'] for actor in role_details['actors']
+                      if ACTOR_PATTERN.match(actor['name']) and groups.get(actor['name'])]
+            to_add = [name for name in dict.fromkeys(to_add) if name not in assigned]
+            if to_add:
+                plan.append({'project': key, 'role': role_details['name'], 'role_id': role_details['id'],
+                             'groups': to_add})
+    return plan
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--user', default='admin')
     parser.add_argument('--password', required=True)
     parser.add_argument('--host', required=True)
     parser.add_argument('--search', help="Jira username search filter", default='.')
+    parser.add_argument('--jobs', type=int, default=8, help="Concurrent Jira requests and group lookups")
+    parser.add_argument('--apply', action='store_true', default=False, help="Assign the groups, not just report them")
 
     args = parser.parse_args()
-    jira = JIRA(args.host, (args.user, args.password))
+    jira = JIRA(args.host, (args.user, args.password), args.jobs)
     # jira.user_search(args.search)
 
     # For each project, get project roles and then find assigned actors to those roles
-    pattern = re.compile('[a-f0-9]+-[a-f0-9]+.*')
-    projects = jira.get_projects()
-    for project in projects:
-        print("Checking roles in project: {project}".format(project=project['name']))
-        roles = jira.get_project_roles(project['id'])
-        for role, url in roles.items():
-            role_details = jira.query(url)
+    projects = crawl(jira, args.jobs)
+    actor_names = [actor['name'] for (_, roles) in projects.values() for role_details in roles
+                   for actor in role_details['actors'] if ACTOR_PATTERN.match(actor['name'])]
+    groups = azure_wrapper.lookup_groups(actor_names, args.jobs)
+
+    for (key, (project, roles)) in sorted(projects.items()):
+        for role_details in roles:
             for actor in role_details['actors']:
-                if pattern.match(actor['name']):
-                    try:
-                        group_info = azure_wrapper.get_group(actor['name'])
-                    except subprocess.CalledProcessError:
-                        group_info = None
-
-                    if group_info:
-                        print("Visit: https://{host}/plugins/servlet/project-config/{key}/roles".format(
-                            host=args.host, key=project['key']
-                        ))
-                        print("   and assign group: {group_name}".format(group_name=group_info['displayName']))
-                        actor_to_add = {"group": [group_info['displayName']]}
-                        jira.add_actor_to_project_role(project['key'], role_details['id'], actor_to_add)
-
-                        exit(-1)
+                group_info = groups.get(actor['name'])
+                if group_info:
+                    print("{project} - {role}: {actor} is group {group_name}".format(
+                        project=key, role=role_details['name'], actor=actor['name'],
+                        group_name=group_info['displayName'])
+                    )
                     # print(json.dumps(role_details, indent=4, separators=(',', ': ')))
+
+    plan = update_plan(projects, groups)
+    for update in plan:
+        print("Visit: https://{host}/plugins/servlet/project-config/{key}/roles".format(
+            host=args.host, key=update['project']
+        ))
+        print("   and assign group(s) to {role}: {groups}".format(
+            role=update['role'], groups=', '.join(update['groups'])
+        ))
+        if args.apply:
+            # All groups of a role are assigned with one request
+            jira.add_actor_to_project_role(update['project'], update['role_id'], {"group": update['groups']})
+
+    print("{count} role updates {done}".format(count=len(plan), done='applied' if args.apply else 'planned'))
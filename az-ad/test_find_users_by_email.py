@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+import json
+import os
+import sys
+import types
+import unittest
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+# graph_config is local (not committed) and adal is only needed to acquire tokens, neither is used here
+sys.modules.setdefault('graph_config', types.SimpleNamespace(
+    GRAPH_AUTHORITY='https://login.example.com/tenant', API_BASE='https://graph.microsoft.com', API_VERSION='v1.0',
+    CLIENT_ID='client', CLIENT_SECRET='secret',
+))
+sys.modules.setdefault('adal', types.ModuleType('adal'))
+
+os.environ['AZURE_WRAPPER_BACKEND'] = 'graph'
+import azure_wrapper  # noqa: E402
+import graph  # noqa: E402
+import graph_wrapper  # noqa: E402
+
+USERS = [
+    {'id': 'id-plus', 'mail': 'a+b@x.com'},
+    {'id': 'id-hash', 'mail': 'c#d@x.com'},
+    {'id': 'id-quote', 'mail': "o'k@x.com"},
+]
+
+
+def _directory(method, url, params=None, **kwargs):
+    """Answers /users?$filter=mail eq '...' or ... the way Graph would, after decoding the url sent by requests"""
+    query = parse_qs(urlparse(requests.Request(method, url, params=params).prepare().url).query)
+    wanted = [clause.split(" eq '", 1)[1][:-1].replace("''", "'") for clause in query['$filter'][0].split(' or ')]
+    response = requests.Response()
+    response.status_code = 200
+    response._content = json.dumps({'value': [u for u in USERS if u['mail'] in wanted]}).encode('utf-8')
+    return response
+
+
+class FindUsersByEmailTest(unittest.TestCase):
+    def setUp(self):
+        tokens = mock.Mock()
+        tokens.token.return_value = 'token'
+        client = graph.Graph(sys.modules['graph_config'], tokens)
+        client.session.request = _directory
+        patcher = mock.patch.object(graph_wrapper, '_client', client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_special_characters_are_resolved(self):
+        result = azure_wrapper.find_users_by_email(['a+b@x.com', 'c#d@x.com', "o'k@x.com", 'missing@x.com'])
+
+        self.assertEqual('id-plus', result['a+b@x.com']['objectId'])
+        self.assertEqual('id-hash', result['c#d@x.com']['objectId'])
+        self.assertEqual('id-quote', result["o'k@x.com"]['objectId'])
+        self.assertIsNone(result['missing@x.com'])
+
+
+if __name__ == '__main__':
+    unittest.main()
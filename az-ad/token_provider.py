@@ -0,0 +1,80 @@
+import json
+import os
+import threading
+import time
+
+import adal
+
+"""
+Access tokens for the Graph API (client credentials, see graph_config), cached on disk so short scripts don't
+authenticate every run, and refreshed before they expire so long running audits keep working.
+
+"""
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'az-ad', 'tokens.json')
+
+
+class TokenProvider(object):
+    """
+    Tokens are reused from cache_path (readable by the owner only, None to not cache on disk) across processes and
+    refreshed refresh_margin seconds before they expire. Used by Graph, and through it by graph_wrapper.
+    """
+    def __init__(self, config, cache_path=DEFAULT_CACHE, refresh_margin=300):
+        self.config = config
+        self.cache_path = cache_path
+        self.refresh_margin = refresh_margin
+        self.key = '{config.GRAPH_AUTHORITY} {config.CLIENT_ID} {config.API_BASE}'.format(config=config)
+        self.lock = threading.Lock()
+        self._token = None
+
+    def token(self, force_refresh=False):
+        """
+        A valid access token, force_refresh acquires a new one (e.g. after a 401) even if the current one looks valid
+        """
+        with self.lock:
+            if force_refresh or not self._valid(self._token):
+                cached = None if force_refresh else self._load()
+                self._token = cached if self._valid(cached) else self._acquire()
+            return self._token['accessToken']
+
+    def _valid(self, token):
+        return token is not None and token['expiresAt'] - self.refresh_margin > time.time()
+
+    def _acquire(self):
+        context = adal.AuthenticationContext(self.config.GRAPH_AUTHORITY)
+        result = context.acquire_token_with_client_credentials(
+            self.config.API_BASE, self.config.CLIENT_ID, self.config.CLIENT_SECRET
+        )
+        token = {'accessToken': result['accessToken'], 'expiresAt': time.time() + result['expiresIn']}
+        self._save(token)
+        return token
+
+    def _load(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return None
+
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f).get(self.key)
+        except ValueError:
+            return None
+
+    def _save(self, token):
+        if not self.cache_path:
+            return
+
+        os.makedirs(os.path.dirname(self.cache_path), mode=0o700, exist_ok=True)
+        tokens = {}
+        if os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path) as f:
+                    tokens = json.load(f)
+            except ValueError:
+                pass
+        tokens[self.key] = token
+
+        # Write a new file created with owner only permissions, then replace the cache with it
+        tmp_path = '{path}.{pid}'.format(path=self.cache_path, pid=os.getpid())
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(tokens, f)
+        os.replace(tmp_path, self.cache_path)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import spiders  # noqa: E402
+import spiders.github  # noqa: E402
+import versions  # noqa: E402
+from replay import ReplayServer, rewrites  # noqa: E402
+
+"""
+Benchmark Versions.scan against the local replay server (and fake kubectl) for configs of different sizes.
+Reports scans/second, per spider latency percentiles and memory allocated during a scan.
+
+E.g. ./bench.py --sizes 10,100,1000 --jobs 8 --latency 0.02 --page-size 50 --throttle-rate 0.01
+
+"""
+
+
+def _current(i, dockerfile):
+    kind = i % 3
+    if kind == 0:
+        return {'name': 'DockerfileSpider', 'params': {'path': dockerfile}}
+    if kind == 1:
+        return {'name': 'KubernetesVersionLabelSpider',
+                'params': {'item': 'deploy', 'name': 'app{n}'.format(n=i % 20), 'namespace': 'bench'}}
+    return {'name': 'KubernetesImageVersionSpider',
+            'params': {'item': 'statefulset', 'name': 'app{n}'.format(n=i % 20), 'namespace': 'bench',
+                       'pattern': 'spec.template.spec.containers.0.image'}}
+
+
+def _latest(i):
+    kind = i % 7
+    if kind == 0:
+        return {'name': 'GithubReleaseSpider', 'params': {'owner': 'owner', 'repository': 'repo{i}'.format(i=i)}}
+    if kind == 1:
+        return {'name': 'GithubMixedReleaseSpider',
+                'params': {'owner': 'owner', 'repository': 'repo{i}'.format(i=i), 'major': '2'}}
+    if kind == 2:
+        return {'name': 'DockerHubSpider', 'params': {'owner': 'owner', 'name': 'image{i}'.format(i=i)}}
+    if kind == 3:
+        return {'name': 'BitbucketReleaseSpider', 'params': {'owner': 'owner', 'repository': 'repo{i}'.format(i=i)}}
+    if kind == 4:
+        return {'name': 'AlpinePackageSpider', 'params': {'name': 'pkg{i}'.format(i=i), 'branch': 'v3.18'}}
+    if kind == 5:
+        return {'name': 'JenkinsStableSpider', 'params': {}}
+    return {'name': 'SonarQubeReleaseSpider', 'params': {}}
+
+
+def write_config(size, directory):
+    dockerfile = os.path.join(directory, 'Dockerfile')
+    with open(dockerfile, 'w') as f:
+        f.write('FROM registry.example.com/app:v1.2.3\n')
+
+    config = {'versions': [{'name': 'component{i:04d}'.format(i=i), 'current': _current(i, dockerfile),
+                            'latest': _latest(i)} for i in range(size)]}
+    path = os.path.join(directory, 'config-{size}.yaml'.format(size=size))
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+class TimedVersions(versions.Versions):
+    """Versions recording the latency of every spider invocation by spider class"""
+    def __init__(self, config_file, beautify, github=None):
+        super().__init__(config_file, beautify, github)
+        self.latencies = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    def _get_version(self, config, spider):
+        start = time.perf_counter()
+        try:
+            return super()._get_version(config, spider)
+        finally:
+            with self.lock:
+                self.latencies[config['name']].append(time.perf_counter() - start)
+
+
+def _percentiles(values):
+    if len(values) == 1:
+        return values * 3
+    quantiles = statistics.quantiles(values, n=100, method='inclusive')
+    return quantiles[49], quantiles[89], quantiles[98]
+
+
+def run(config, runs, jobs, github, kube_snapshot):
+    durations = []
+    errors = 0
+    bench = None
+    for _ in range(runs):
+        # A fresh snapshot per scan, otherwise only the first scan would call kubectl
+        spiders.configure_kubernetes_snapshot(kube_snapshot)
+        bench = TimedVersions(config, True, github)
+        start = time.perf_counter()
+        errors += sum(1 for item in bench.scan(jobs) if item.error)
+        durations.append(time.perf_counter() - start)
+
+    spiders.configure_kubernetes_snapshot(kube_snapshot)
+    tracemalloc.start()
+    traced = TimedVersions(config, True, github)
+    list(traced.scan(jobs))
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return durations, errors, bench.latencies, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10,100', help="Comma separated config sizes (entries) to benchmark")
+    parser.add_argument('--runs', type=int, default=3, help="Timed scans per config size")
+    parser.add_argument('--jobs', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.0, help="Injected seconds of latency per request/kubectl")
+    parser.add_argument('--page-size', type=int, default=50, help="Max items per page served by the replay server")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument('--host-concurrency', type=int, default=8)
+    parser.add_argument('--host-rate', type=float, default=1000.0)
+    parser.add_argument('--kube-snapshot', action='store_true', default=False)
+    parser.add_argument('--github-graphql', action='store_true', default=False)
+    args = parser.parse_args()
+
+    server = ReplayServer(('127.0.0.1', 0), latency=args.latency, page_size=args.page_size,
+                          throttle_rate=args.throttle_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    os.environ['PATH'] = BENCH_DIR + os.pathsep + os.environ['PATH']
+    os.environ['KUBECTL_LATENCY'] = str(args.latency)
+    spiders.transport.configure(max_concurrency=args.host_concurrency, rate=args.host_rate,
+                                burst=args.host_rate, rewrites=rewrites(server.base_url))
+
+    github = None
+    if args.github_graphql:
+        github = spiders.github.GithubGraphQL('replay', url=server.base_url + '/github/graphql')
+
+    with tempfile.TemporaryDirectory() as directory:
+        for size in [int(s) for s in args.sizes.split(',')]:
+            config = write_config(size, directory)
+            requests_before = server.requests
+            (durations, errors, latencies, peak) = run(config, args.runs, args.jobs, github, args.kube_snapshot)
+
+            print("{size} entries: {scans:.2f} scans/s (mean {mean:.3f}s over {runs} runs), {errors} errors, "
+                  "{requests} requests ({throttled} throttled in total), peak memory {peak:.1f} MB".format(
+                      size=size, scans=len(durations) / sum(durations), mean=statistics.mean(durations),
+                      runs=len(durations), errors=errors, requests=server.requests - requests_before,
+                      throttled=server.throttled, peak=peak / 1024 / 1024))
+            print("  {spider:<32}{count:>6}{p50:>10}{p90:>10}{p99:>10}".format(
+                spider='spider (last run)', count='calls', p50='p50 ms', p90='p90 ms', p99='p99 ms'))
+            for (spider, values) in sorted(latencies.items()):
+                (p50, p90, p99) = _percentiles(values)
+                print("  {spider:<32}{count:>6}{p50:>10.1f}{p90:>10.1f}{p99:>10.1f}".format(
+                    spider=spider, count=len(values), p50=p50 * 1000, p90=p90 * 1000, p99=p99 * 1000))
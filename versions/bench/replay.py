@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import argparse
+import http.server
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlencode, urlparse
+
+"""
+Local replay stand-in for the upstream services used by the spiders (Github, Docker Hub, Bitbucket, Alpine, Jenkins and
+SonarQube). Responses are served from the fixtures directory, list endpoints are paginated and latency and throttling
+(429) can be injected. Point the spiders at it using spiders.transport.configure(rewrites=rewrites(base_url)).
+
+"""
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def rewrites(base_url):
+    """Transport rewrites sending every spider request to the replay server at base_url"""
+    return {
+        'https://api.github.com': base_url + '/github',
+        'https://registry.hub.docker.com': base_url + '/dockerhub',
+        'https://api.bitbucket.org': base_url + '/bitbucket',
+        'https://pkgs.alpinelinux.org': base_url + '/alpine',
+        'https://jenkins.io': base_url + '/jenkins',
+        'https://binaries.sonarsource.com': base_url + '/sonarqube',
+    }
+
+
+class ReplayServer(http.server.ThreadingHTTPServer):
+    """
+    latency: seconds to wait before every response
+    page_size: max items per page for list endpoints (regardless of what the client asks for)
+    throttle_rate: fraction of requests answered with 429 and a Retry-After of retry_after seconds
+    """
+    daemon_threads = True
+
+    def __init__(self, address, fixtures=FIXTURES, latency=0.0, page_size=None, throttle_rate=0.0, retry_after=0):
+        super().__init__(address, ReplayHandler)
+        self.fixtures = fixtures
+        self.latency = latency
+        self.page_size = page_size
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.requests = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    @property
+    def base_url(self):
+        return 'http://{host}:{port}'.format(host=self.server_address[0], port=self.server_address[1])
+
+    def handle_error(self, request, client_address):
+        """Streaming spiders hang up as soon as they have what they need, that's expected"""
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+    def fixture(self, name):
+        if name not in self.cache:
+            with open(os.path.join(self.fixtures, name), 'rb') as f:
+                self.cache[name] = f.read()
+        return self.cache[name]
+
+    def json_fixture(self, name):
+        return json.loads(self.fixture(name))
+
+
+class ReplayHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    routes = [
+        ('GET', re.compile(r'^/github/repos/[^/]+/[^/]+/releases/latest$'), 'github_latest_release'),
+        ('GET', re.compile(r'^/github/repos/[^/]+/[^/]+/releases$'), 'github_releases'),
+        ('POST', re.compile(r'^/github/graphql$'), 'github_graphql'),
+        ('GET', re.compile(r'^/dockerhub/v2/repositories/[^/]+/[^/]+/tags$'), 'dockerhub_tags'),
+        ('GET', re.compile(r'^/bitbucket/2.0/repositories/[^/]+/[^/]+/refs/tags$'), 'bitbucket_tags'),
+        ('GET', re.compile(r'^/alpine/packages$'), 'alpine_packages'),
+        ('GET', re.compile(r'^/jenkins/changelog-stable/$'), 'jenkins_changelog'),
+        ('GET', re.compile(r'^/sonarqube/Distribution/sonarqube/$'), 'sonarqube_index'),
+    ]
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        # Always consume the request body, keeping the connection usable when the request is throttled
+        self.body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.server.lock:
+            self.server.requests += 1
+            throttle = random.random() < self.server.throttle_rate
+            if throttle:
+                self.server.throttled += 1
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if throttle:
+            self._respond(429, b'', 'text/plain', {'Retry-After': str(self.server.retry_after)})
+            return
+
+        for (route_method, pattern, name) in self.routes:
+            if route_method == method and pattern.match(url.path):
+                getattr(self, name)(url)
+                return
+
+        self._respond(404, b'Not found', 'text/plain')
+
+    def github_latest_release(self, url):
+        self._respond(200, self.server.fixture('github_latest_release.json'), 'application/json')
+
+    def github_releases(self, url):
+        self._respond(200, self.server.fixture('github_releases.json'), 'application/json')
+
+    def github_graphql(self, url):
+        request = json.loads(self.body)
+        variables = request['variables']
+        latest = self.server.json_fixture('github_latest_release.json')
+        releases = self.server.json_fixture('github_releases.json')[:variables['releases']]
+        repository = {
+            'latestRelease': {'tagName': latest['tag_name']},
+            'releases': {'nodes': [{'tagName': r['tag_name'], 'isDraft': r['draft']} for r in releases]},
+        }
+        data = {}
+        i = 0
+        while 'o{i}'.format(i=i) in variables:
+            data['r{i}'.format(i=i)] = repository
+            i += 1
+        self._respond(200, json.dumps({'data': data}).encode('utf-8'), 'application/json')
+
+    def dockerhub_tags(self, url):
+        self._paginate(url, 'dockerhub_tags.json', 'results', 'page_size')
+
+    def bitbucket_tags(self, url):
+        self._paginate(url, 'bitbucket_tags.json', 'values', 'pagelen')
+
+    def alpine_packages(self, url):
+        self._respond(200, self.server.fixture('alpine_packages.html'), 'text/html')
+
+    def jenkins_changelog(self, url):
+        self._respond(200, self.server.fixture('jenkins_changelog.html'), 'text/html')
+
+    def sonarqube_index(self, url):
+        self._respond(200, self.server.fixture('sonarqube_index.html'), 'text/html')
+
+    def _paginate(self, url, fixture, key, size_param):
+        query = parse_qs(url.query)
+        items = self.server.json_fixture(fixture)[key]
+        size = int(query.get(size_param, ['10'])[0])
+        if self.server.page_size:
+            size = min(size, self.server.page_size)
+        page = int(query.get('page', ['1'])[0])
+
+        data = {key: items[(page - 1) * size:page * size], 'page': page}
+        if page * size < len(items):
+            query['page'] = [str(page + 1)]
+            data['next'] = '{base}{path}?{query}'.format(
+                base=self.server.base_url, path=url.path, query=urlencode(query, doseq=True)
+            )
+        self._respond(200, json.dumps(data).encode('utf-8'), 'application/json')
+
+    def _respond(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds to wait before every response")
+    parser.add_argument('--page-size', type=int, help="Max items per page for list endpoints")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument('--retry-after', type=int, default=0, help="Retry-After seconds sent with a 429")
+    args = parser.parse_args()
+
+    server = ReplayServer(('127.0.0.1', args.port), latency=args.latency, page_size=args.page_size,
+                          throttle_rate=args.throttle_rate, retry_after=args.retry_after)
+    print("Replaying fixtures on {url}".format(url=server.base_url))
+    server.serve_forever()
@@ -1,19 +1,122 @@
 import abc
+import contextlib
+import functools
+import inspect
 import os.path
 import re
 import subprocess
+import time
+import tracemalloc
+from urllib.parse import urlparse
 
-from natsort import natsorted
-import requests
-import yaml
-from lxml import html
+from spiders.cache import ResponseCache
+from spiders.kubernetes import KubernetesSnapshot
+from spiders import transport
+from spiders import version as version_key
 
 """
 Various 'spiders' that know how to retrieve version information from different sources.
+Heavy dependencies (requests, lxml, yaml) are imported lazily, each spider lists the modules it needs in requires.
 
 """
 
+_response_cache = None
+_kubernetes_snapshot = None
 
+
+def configure_cache(directory, max_size=50 * 1024 * 1024):
+    """
+    Enable the on-disk response cache shared by all spiders, pass None as directory to disable it again
+    """
+    global _response_cache
+    _response_cache = ResponseCache(directory, max_size) if directory else None
+
+
+def _get(url, ttl=0):
+    """
+    GET url, using the response cache if enabled. ttl is the number of seconds a cached response is considered fresh
+    """
+    if _response_cache:
+        return _response_cache.get(url, ttl)
+
+    return transport.get(url)
+
+
+def _stream(url, ttl=0, chunk_size=16 * 1024):
+    """
+    Yield the response body for url in chunks while it is downloaded, closing the connection when the consumer stops
+    iterating. With the response cache enabled the (cached) body is yielded in chunks instead.
+    """
+    if _response_cache:
+        response = _response_cache.get(url, ttl)
+        response.raise_for_status()
+        for start in range(0, len(response.content), chunk_size):
+            yield response.content[start:start + chunk_size]
+        return
+
+    response = transport.get(url, stream=True)
+    stats = transport.current_stats()
+    try:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size):
+            if stats:
+                stats.add_bytes(urlparse(response.url).netloc, len(chunk))
+            yield chunk
+    finally:
+        response.close()
+
+
+def _iter_pages(url, ttl=0, max_pages=10):
+    """
+    Yield the json pages of a paginated API starting at url, following next links until there are no more pages or
+    max_pages pages have been fetched. Pages are fetched lazily so a consumer that stops iterating stops fetching.
+    """
+    pages = 0
+    while url and pages < max_pages:
+        response = _get(url, ttl)
+        response.raise_for_status()
+        data = response.json()
+        pages += 1
+        yield data
+        url = data.get('next')
+
+
+def configure_kubernetes_snapshot(enabled, path=None):
+    """
+    Let all kubernetes spiders share one snapshot, listing each (namespace, kind) once instead of one kubectl call per
+    spider. With a path the snapshot is loaded from a saved kubectl get ... -o json file and kubectl is never invoked.
+    """
+    global _kubernetes_snapshot
+    _kubernetes_snapshot = KubernetesSnapshot(path) if enabled else None
+
+
+def invalidate_kubernetes_snapshot(spiders):
+    """
+    Forget the (namespace, kind) listings used by the kubernetes spiders among spiders, so that their next get_version
+    calls kubectl again (e.g. on every refresh in watch mode). A snapshot loaded from a file is kept as is.
+    """
+    if _kubernetes_snapshot:
+        for spider in spiders:
+            if isinstance(spider, (KubernetesVersionLabelSpider, KubernetesImageVersionSpider)):
+                _kubernetes_snapshot.invalidate(spider.item, spider.namespace)
+
+
+def _get_kubernetes_object(item, name, namespace):
+    if _kubernetes_snapshot:
+        return _kubernetes_snapshot.get(item, name, namespace)
+
+    kubectl_command = "kubectl get {item} {name} -n {namespace} -o yaml".format(
+        item=item, name=name, namespace=namespace
+    )
+    start = time.perf_counter()
+    result = subprocess.run(kubectl_command, shell=True, check=True, stdout=subprocess.PIPE, encoding='utf-8')
+    if transport.current_stats():
+        transport.current_stats().add_request('kubectl', time.perf_counter() - start, len(result.stdout))
+    import yaml
+    return yaml.safe_load(result.stdout)
+
+
+@functools.lru_cache(maxsize=16384)
 def _beautify_version(version, beautify):
     """
     Attempts to return the numerical part of a version by stripping away common prefix and postfix notation
@@ -34,8 +137,7 @@ def _beautify_version(version, beautify):
 
 
 def _contains_version(candidate):
-    beautified = _beautify_version(candidate, True)
-    return re.match(r'[\d+.]+', beautified)
+    return version_key.contains_version(candidate)
 
 
 def _get_version_from_metadata_label(yaml_data):
@@ -55,27 +157,83 @@ def _get_version_from_metadata_label(yaml_data):
         return labels['apps.kubernetes.io/version']
 
 
+def get_spider_class(name):
+    """
+    Look up a spider class by name, raises ValueError for names not matching a (concrete) spider
+    """
+    spider_class = globals().get(name)
+    if not (inspect.isclass(spider_class) and issubclass(spider_class, AbstractSpider)) \
+            or inspect.isabstract(spider_class):
+        raise ValueError("Unknown spider: {name}".format(name=name))
+
+    return spider_class
+
+
 class AbstractSpider(abc.ABC):
 
     """
-    Base class for all spiders
+    Base class for all spiders. cache_ttl is the number of seconds a cached response is used without revalidation,
+    requires lists the (heavy) modules needed by the spider so they can be loaded up front for the spiders in use only.
     """
+    cache_ttl = 0
+    requires = ()
+
     @abc.abstractmethod
     def get_version(self, beautify):
         pass
 
 
+class AbstractStreamingSpider(AbstractSpider):
+    """
+    Base class for spiders scraping large HTML pages. The page is parsed incrementally while it is downloaded so the
+    spider can stop reading as soon as it has found what it needs. Each run records bytes_read and, if tracemalloc is
+    tracing, peak_memory (bytes allocated above the level at the start of the run). tracemalloc is process wide, so
+    peak_memory is only accurate when spiders run one at a time.
+    """
+    requires = ('requests', 'lxml.etree')
+    chunk_size = 16 * 1024
+    bytes_read = 0
+    peak_memory = None
+
+    def _iter_html(self, events):
+        """Yield lxml (event, element) tuples for self.url, see lxml.etree.HTMLPullParser for events"""
+        self.bytes_read = 0
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+
+        from lxml import etree
+
+        try:
+            parser = etree.HTMLPullParser(events=events)
+            for chunk in _stream(self.url, self.cache_ttl, self.chunk_size):
+                self.bytes_read += len(chunk)
+                parser.feed(chunk)
+                yield from parser.read_events()
+            parser.close()
+            yield from parser.read_events()
+        finally:
+            if tracing:
+                self.peak_memory = tracemalloc.get_traced_memory()[1] - start
+
+
 class AlpinePackageSpider(AbstractSpider):
     """
     Grab the latest (only?) version for an alpine package that exists for specific alpine version
     """
+    cache_ttl = 3600
+    requires = ('requests', 'lxml.html')
+
     def __init__(self, name, branch) -> None:
         url = "https://pkgs.alpinelinux.org/packages?name={name}&branch={branch}&arch=x86_64"
         self.url = url.format(name=name, branch=branch)
 
     def get_version(self, beautify):
-        response = requests.get(self.url)
+        response = _get(self.url, self.cache_ttl)
         response.raise_for_status()
+        from lxml import html
+
         tree = html.fromstring(response.content)
         version_list = tree.xpath('//td[@class="version"]/text()')
         return _beautify_version(version_list[0], beautify)
@@ -84,19 +242,30 @@ class AlpinePackageSpider(AbstractSpider):
 class BitbucketReleaseSpider(AbstractSpider):
     """
     Retrieve version from Bitbucket tags. Assumes x.y.z tags are used!
+    Tags are requested sorted by name (descending) so the first x.y.z tag found is the one to use, later pages are
+    only fetched while no such tag has been found (at most max_pages).
     """
-    def __init__(self, owner, repository):
+    cache_ttl = 300
+    requires = ('requests',)
+
+    def __init__(self, owner, repository, max_pages=10):
         api = "https://api.bitbucket.org/2.0/repositories/{owner}/{repository}/refs/tags?sort=-name&pagelen=100"
         self.url = api.format(owner=owner, repository=repository)
         self.version_pattern = re.compile('^\d+.\d+.\d+$')
+        self.max_pages = max_pages
+        self.pages_fetched = 0
 
     def get_version(self, beautify):
-        response = requests.get(self.url)
-        response.raise_for_status()
-        data = response.json()
-
-        versions = [x['name'] for x in data['values'] if self.version_pattern.match(x['name'])]
-        return _beautify_version(versions[0], beautify)
+        self.pages_fetched = 0
+        for page in _iter_pages(self.url, self.cache_ttl, self.max_pages):
+            self.pages_fetched += 1
+            versions = [x['name'] for x in page['values'] if self.version_pattern.match(x['name'])]
+            if versions:
+                return _beautify_version(versions[0], beautify)
+
+        raise ValueError("No x.y.z tag found in {pages} page(s) of {url}".format(
+            pages=self.pages_fetched, url=self.url)
+        )
 
 
 class DockerfileSpider(AbstractSpider):
@@ -123,38 +292,64 @@ class DockerfileSpider(AbstractSpider):
 
 class DockerHubSpider(AbstractSpider):
     """
-    Retrieve version from Docker hub tags list, sorting all versions using natsort to find the highest one.
-    Assumes the tag names only contains versions!
+    Retrieve version from Docker hub tags list, selecting the highest one using parsed version keys.
+    Docker hub can't sort tags by name, so no page is known to hold the highest version: all pages are scanned (at
+    most max_pages) before picking it.
     """
-    def __init__(self, owner, name):
+    cache_ttl = 300
+    requires = ('requests',)
+
+    def __init__(self, owner, name, max_pages=10):
         self.owner = owner
         self.name = name
         api = "https://registry.hub.docker.com/v2/repositories/{owner}/{name}/tags?page_size=100"
         self.url = api.format(owner=self.owner, name=self.name)
         self.version_pattern = re.compile('^\d+.\d+.\d+(-\d)?$')
+        self.max_pages = max_pages
+        self.pages_fetched = 0
 
     def get_version(self, beautify):
-        response = requests.get(self.url)
-        response.raise_for_status()
+        self.pages_fetched = 0
+        tags = []
+        for page in _iter_pages(self.url, self.cache_ttl, self.max_pages):
+            self.pages_fetched += 1
+            tags.extend(x['name'] for x in page['results'] if self.version_pattern.match(x['name']))
 
-        data = response.json()
-        unsorted = [x['name'] for x in data['results'] if self.version_pattern.match(x['name'])]
-        versions = natsorted(unsorted, reverse=True)
-        return _beautify_version(versions[0], beautify)
+        highest = version_key.latest(tags)
+        if highest is None:
+            raise ValueError("No version tags found in {pages} page(s) for {owner}/{name}".format(
+                pages=self.pages_fetched, owner=self.owner, name=self.name)
+            )
+
+        return _beautify_version(highest, beautify)
 
 
 class GithubReleaseSpider(AbstractSpider):
     """
-    Retrieve version for the latest release of a Github project using the Github API
+    Retrieve version for the latest release of a Github project using the Github API.
+    prefetched is filled in by the batched GraphQL backend (spiders.github), if used.
     """
+    cache_ttl = 300
+    requires = ('requests',)
+
     def __init__(self, owner, repository):
         api = 'https://api.github.com/repos/{owner}/{repository}/releases/latest'
         self.url = api.format(owner=owner, repository=repository)
+        self.owner = owner
+        self.repository = repository
+        self.prefetched = None
 
     def get_version(self, beautify):
         """Response contains a Github release API response and since we request latest the tag_name will correspond
         to the actual latest available version"""
-        response = requests.get(self.url)
+        if self.prefetched:
+            if self.prefetched['latest'] is None:
+                raise ValueError("No release found for {owner}/{repository}".format(
+                    owner=self.owner, repository=self.repository)
+                )
+            return _beautify_version(self.prefetched['latest'], beautify)
+
+        response = _get(self.url, self.cache_ttl)
         response.raise_for_status()
         return _beautify_version(response.json()['tag_name'], beautify)
 
@@ -162,58 +357,72 @@ class GithubReleaseSpider(AbstractSpider):
 class GithubMixedReleaseSpider(AbstractSpider):
     """
     Github release spider assumes latest is the latest. Some repositories mix multiple major versions in their releases
+    prefetched is filled in by the batched GraphQL backend (spiders.github), if used.
     """
+    cache_ttl = 300
+    requires = ('requests',)
+
     def __init__(self, owner, repository, major):
         api = 'https://api.github.com/repos/{owner}/{repository}/releases'
         self.url = api.format(owner=owner, repository=repository)
+        self.owner = owner
+        self.repository = repository
         self.major = major
+        self.prefetched = None
 
     def get_version(self, beautify):
-        response = requests.get(self.url)
-        response.raise_for_status()
-        data = response.json()
-        for release in data:
-            version = _beautify_version(release['tag_name'], True)
+        if self.prefetched:
+            tags = self.prefetched['releases']
+        else:
+            response = _get(self.url, self.cache_ttl)
+            response.raise_for_status()
+            tags = [release['tag_name'] for release in response.json()]
+
+        for tag in tags:
+            version = _beautify_version(tag, True)
             if version.startswith(self.major):
-                return version if beautify else release['tag_name']
+                return version if beautify else tag
 
         raise ValueError("Failed to locate a release matching major version: {major}".format(major=self.major))
 
 
-class JenkinsStableSpider(AbstractSpider):
+class JenkinsStableSpider(AbstractStreamingSpider):
     """
     Retrieve version for the latest stable Jenkins release (parse the published LTS changelog)
     """
+    cache_ttl = 3600
+
     def __init__(self):
         self.url = "https://jenkins.io/changelog-stable/"
 
     def get_version(self, beautify):
         """
-        XPath version scanner for the Jenkins Stable/LTS change log page
-        Usually the version there begins with a v
+        Streaming version scanner for the Jenkins Stable/LTS change log page, reads the page until the id of the first
+        h3 in <div class="ratings"> is found. Usually the version there begins with a v
         """
-        response = requests.get(self.url)
-        response.raise_for_status()
-        tree = html.fromstring(response.content)
-        version_list = tree.xpath('//div[@class="ratings"]/h3[1]/@id')
-        return _beautify_version(version_list[0], beautify)
+        with contextlib.closing(self._iter_html(events=('start',))) as events:
+            for (_, element) in events:
+                parent = element.getparent()
+                if element.tag == 'h3' and parent is not None and parent.tag == 'div' \
+                        and parent.get('class') == 'ratings' and element.get('id'):
+                    return _beautify_version(element.get('id'), beautify)
+
+        raise ValueError("JenkinsStableSpider failed to locate any release")
 
 
 class KubernetesVersionLabelSpider(AbstractSpider):
     """
     Retrieve version from a running k8s deployment assuming it's been labeled with app.kubernetes.io/version
     """
+    requires = ('yaml',)
+
     def __init__(self, item, name, namespace):
         self.item = item
         self.name = name
         self.namespace = namespace
 
     def get_version(self, beautify):
-        kubectl_command = "kubectl get {item} {name} -n {namespace} -o yaml".format(
-            item=self.item, name=self.name, namespace=self.namespace
-        )
-        result = subprocess.run(kubectl_command, shell=True, check=True, stdout=subprocess.PIPE, encoding='utf-8')
-        data = yaml.load(result.stdout)
+        data = _get_kubernetes_object(self.item, self.name, self.namespace)
         return _beautify_version(_get_version_from_metadata_label(data), beautify)
 
 
@@ -223,6 +432,8 @@ class KubernetesImageVersionSpider(AbstractSpider):
     For a stateful set the pattern could be: spec.template.spec.containers.0.image
     This spider does support numeric indexes used for list items.
     """
+    requires = ('yaml',)
+
     def __init__(self, item, name, namespace, pattern):
         self.item = item
         self.name = name
@@ -230,11 +441,7 @@ class KubernetesImageVersionSpider(AbstractSpider):
         self.pattern = pattern
 
     def get_version(self, beautify):
-        kubectl_command = "kubectl -n {namespace} get {item} {name} -o yaml".format(
-            namespace=self.namespace, item=self.item, name=self.name
-        )
-        result = subprocess.run(kubectl_command, shell=True, check=True, stdout=subprocess.PIPE, encoding='utf-8')
-        data = yaml.load(result.stdout)
+        data = _get_kubernetes_object(self.item, self.name, self.namespace)
         section = data
         for p in self.pattern.split('.'):
             if isinstance(section, list):
@@ -247,28 +454,36 @@ class KubernetesImageVersionSpider(AbstractSpider):
         return _beautify_version(version, beautify)
 
 
-class SonarQubeReleaseSpider(AbstractSpider):
+class SonarQubeReleaseSpider(AbstractStreamingSpider):
     """
     Retrieves version using SonarQubes download pages (HTML scrape). Hopefully somewhat stable page.
     """
+    cache_ttl = 3600
+
     def __init__(self):
         self.url = 'https://binaries.sonarsource.com/Distribution/sonarqube/'
 
     def get_version(self, beautify):
         """
-        XPath version scanner for the SonarQube Distribution page. Finds all downloads for sonarqube and sorts them
+        Streaming version scanner for the SonarQube Distribution page. Collects all downloads for sonarqube and picks
+        the highest. Every link is needed so the whole page is read, but parsed elements are discarded as we go.
         """
-        response = requests.get(self.url)
-        response.raise_for_status()
-        tree = html.fromstring(response.content)
-        download_links = tree.xpath('//a/@href')
-        filtered = map(lambda x: x.replace('sonarqube-', '').replace('.zip', ''),
-                       filter(lambda x: x.startswith('sonarqube-') and x.endswith('.zip'), download_links))
-        sorted_downloads = natsorted(filtered, reverse=True)
-        if len(sorted_downloads) == 0:
+        downloads = []
+        with contextlib.closing(self._iter_html(events=('end',))) as events:
+            for (_, element) in events:
+                href = element.get('href', '') if element.tag == 'a' else ''
+                if href.startswith('sonarqube-') and href.endswith('.zip'):
+                    downloads.append(href.replace('sonarqube-', '').replace('.zip', ''))
+
+                element.clear(keep_tail=True)
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+        highest = version_key.latest(downloads)
+        if highest is None:
             raise ValueError("SonarQubeReleaseSpider failed to locate any releases")
 
-        return _beautify_version(sorted_downloads[0], beautify)
+        return _beautify_version(highest, beautify)
 
 
 class NASpider(AbstractSpider):
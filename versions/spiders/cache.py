@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from spiders import transport
+
+"""
+On-disk HTTP response cache shared by all spiders. Stores ETag/Last-Modified validators so that later runs can use
+conditional requests (If-None-Match/If-Modified-Since) instead of downloading unchanged payloads again.
+
+"""
+
+
+class CachedResponse(object):
+    """
+    Minimal stand-in for requests.Response for content served from (or stored in) the cache
+    """
+    def __init__(self, url, status_code, content, from_cache):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.from_cache = from_cache
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.HTTPError("{status} for url: {url}".format(status=self.status_code, url=self.url))
+
+
+class ResponseCache(object):
+    """
+    Stores one metadata file and one body file per url in directory, evicting least recently used entries once the
+    total body size exceeds max_size bytes
+    """
+    def __init__(self, directory, max_size=50 * 1024 * 1024):
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get(self, url, ttl=0):
+        """
+        Return a response for url. Entries younger than ttl seconds are served without contacting the server, older
+        entries are revalidated using a conditional request.
+        """
+        stats = transport.current_stats()
+        entry = self._load(url)
+        if entry and time.time() - entry['stored'] < ttl:
+            if stats:
+                stats.cache_hits += 1
+            return self._hit(url, entry)
+
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        response = transport.get(url, headers=headers)
+        if response.status_code == 304 and entry:
+            if stats:
+                stats.cache_hits += 1
+            entry['stored'] = time.time()
+            self._write(self._path(url, '.json'), json.dumps(entry).encode('utf-8'))
+            return self._hit(url, entry)
+
+        if stats:
+            stats.cache_misses += 1
+        if not response.ok:
+            return response
+
+        self._store(url, response)
+        return CachedResponse(url, response.status_code, response.content, from_cache=False)
+
+    def _hit(self, url, entry):
+        body_path = self._path(url, '.body')
+        with open(body_path, 'rb') as f:
+            content = f.read()
+        os.utime(body_path)
+        return CachedResponse(url, entry['status_code'], content, from_cache=True)
+
+    def _load(self, url):
+        try:
+            with open(self._path(url, '.json')) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if not os.path.exists(self._path(url, '.body')):
+            return None
+
+        return entry
+
+    def _store(self, url, response):
+        entry = {
+            'url': url,
+            'status_code': response.status_code,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'stored': time.time(),
+        }
+        self._write(self._path(url, '.body'), response.content)
+        self._write(self._path(url, '.json'), json.dumps(entry).encode('utf-8'))
+        self._evict()
+
+    def _write(self, path, data):
+        """Write via a temporary file so concurrent readers never see a partial entry"""
+        tmp_path = '{path}.{thread}.tmp'.format(path=path, thread=threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _evict(self):
+        with self.lock:
+            bodies = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.body'):
+                    stat = entry.stat()
+                    bodies.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for (_, size, _) in bodies)
+            for (_, size, path) in sorted(bodies):
+                if total <= self.max_size:
+                    break
+                for p in (path, path[:-len('.body')] + '.json'):
+                    try:
+                        os.remove(p)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+
+    def _path(self, url, suffix):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + suffix)
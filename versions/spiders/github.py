@@ -0,0 +1,68 @@
+from spiders import transport
+
+"""
+Batched Github backend: resolves the releases of many repositories using a few aliased GraphQL queries instead of one
+REST call per repository.
+
+"""
+
+_release_fields = """
+fragment releaseFields on Repository {
+  latestRelease { tagName }
+  releases(first: $releases, orderBy: {field: CREATED_AT, direction: DESC}) { nodes { tagName isDraft } }
+}
+"""
+
+
+class GithubGraphQL(object):
+    """
+    Collects github spiders (anything with owner and repository attributes plus a prefetched attribute) and prefetches
+    their release data, batch_size repositories per query. releases is the number of releases fetched per repository.
+    """
+    def __init__(self, token, batch_size=50, releases=30, url='https://api.github.com/graphql'):
+        self.url = url
+        self.batch_size = batch_size
+        self.releases = releases
+        self.headers = {'Authorization': 'bearer {token}'.format(token=token)}
+        self.queries = 0
+
+    def prefetch(self, spiders):
+        by_repository = {}
+        for spider in spiders:
+            by_repository.setdefault((spider.owner, spider.repository), []).append(spider)
+
+        repositories = sorted(by_repository)
+        for start in range(0, len(repositories), self.batch_size):
+            batch = repositories[start:start + self.batch_size]
+            for (repository, data) in zip(batch, self._query(batch)):
+                if data is None:
+                    # Unknown repository, leave it to the spider (REST) to report the error
+                    continue
+
+                prefetched = {
+                    'latest': data['latestRelease']['tagName'] if data['latestRelease'] else None,
+                    'releases': [r['tagName'] for r in data['releases']['nodes'] if not r['isDraft']],
+                }
+                for spider in by_repository[repository]:
+                    spider.prefetched = prefetched
+
+    def _query(self, batch):
+        """One aliased query for all repositories in batch, returns the repository data in batch order"""
+        declarations = ['$releases: Int!']
+        selections = []
+        variables = {'releases': self.releases}
+        for (i, (owner, name)) in enumerate(batch):
+            declarations.append('$o{i}: String!, $n{i}: String!'.format(i=i))
+            selections.append('r{i}: repository(owner: $o{i}, name: $n{i}) {{ ...releaseFields }}'.format(i=i))
+            variables['o{i}'.format(i=i)] = owner
+            variables['n{i}'.format(i=i)] = name
+
+        query = 'query({declarations}) {{\n{selections}\n}}\n{fragment}'.format(
+            declarations=', '.join(declarations), selections='\n'.join(selections), fragment=_release_fields
+        )
+        response = transport.post(self.url, json={'query': query, 'variables': variables}, headers=self.headers)
+        response.raise_for_status()
+        self.queries += 1
+
+        data = response.json().get('data') or {}
+        return [data.get('r{i}'.format(i=i)) for i in range(len(batch))]
@@ -0,0 +1,110 @@
+import json
+import subprocess
+import threading
+import time
+
+from spiders import transport
+
+"""
+Bulk snapshot backend for the kubernetes spiders. Instead of one kubectl call per object, each (namespace, kind) pair is
+listed once using -o json and indexed by name in memory.
+
+"""
+
+_kind_aliases = {
+    'deploy': 'deployment',
+    'ds': 'daemonset',
+    'sts': 'statefulset',
+    'rs': 'replicaset',
+    'po': 'pod',
+    'svc': 'service',
+    'cm': 'configmap',
+    'ing': 'ingress',
+    'ingresses': 'ingress',
+    'cj': 'cronjob',
+}
+
+
+def _normalize_kind(item):
+    """
+    Map the item name used with kubectl get (deploy, statefulsets, deployments.apps...) to its lower case kind
+    """
+    kind = item.lower().split('.')[0]
+    if kind in _kind_aliases:
+        return _kind_aliases[kind]
+    # networkpolicies -> networkpolicy, storageclasses -> storageclass, deployments -> deployment
+    if kind.endswith('ies'):
+        return kind[:-3] + 'y'
+    if kind.endswith('sses'):
+        return kind[:-2]
+    if kind.endswith('s') and not kind.endswith('ss'):
+        return kind[:-1]
+    return kind
+
+
+class KubernetesSnapshot(object):
+    """
+    In-memory index of kubernetes objects keyed by (namespace, kind) and name.
+    When created from a saved file, e.g. the output of: kubectl get deploy,sts -A -o json > snapshot.json
+    the snapshot is used as is and kubectl is never invoked.
+    """
+    def __init__(self, path=None):
+        self.index = {}
+        self.offline = path is not None
+        self.lock = threading.Lock()
+        self.fetch_locks = {}
+        if path:
+            self.load(path)
+
+    def load(self, path):
+        with open(path) as f:
+            data = json.load(f)
+
+        for obj in data['items']:
+            key = (obj['metadata'].get('namespace'), _normalize_kind(obj['kind']))
+            self.index.setdefault(key, {})[obj['metadata']['name']] = obj
+
+    def get(self, item, name, namespace):
+        key = (namespace, _normalize_kind(item))
+        stats = transport.current_stats()
+        # Read the index once, invalidate() may drop the key at any time
+        objects = self.index.get(key)
+        if objects is not None or self.offline:
+            if stats:
+                stats.cache_hits += 1
+        else:
+            objects = self._fetch(item, namespace, key)
+
+        objects = objects or {}
+        if name not in objects:
+            raise ValueError('{item} {name} not found in namespace {namespace}'.format(
+                item=item, name=name, namespace=namespace)
+            )
+
+        return objects[name]
+
+    def invalidate(self, item, namespace):
+        """Forget the objects of a (namespace, kind) so the next get lists them again, a snapshot file is kept as is"""
+        if self.offline:
+            return
+
+        with self.lock:
+            self.index.pop((namespace, _normalize_kind(item)), None)
+
+    def _fetch(self, item, namespace, key):
+        """List all objects of a kind in namespace, concurrent spiders asking for the same pair wait for one fetch"""
+        with self.lock:
+            fetch_lock = self.fetch_locks.setdefault(key, threading.Lock())
+
+        with fetch_lock:
+            if key in self.index:
+                return self.index[key]
+
+            kubectl_command = "kubectl get {item} -n {namespace} -o json".format(item=item, namespace=namespace)
+            start = time.perf_counter()
+            result = subprocess.run(kubectl_command, shell=True, check=True, stdout=subprocess.PIPE, encoding='utf-8')
+            if transport.current_stats():
+                transport.current_stats().add_request('kubectl', time.perf_counter() - start, len(result.stdout))
+            objects = {obj['metadata']['name']: obj for obj in json.loads(result.stdout)['items']}
+            self.index[key] = objects
+            return objects
@@ -0,0 +1,261 @@
+import contextlib
+import email.utils
+import threading
+import time
+from urllib.parse import urlparse
+
+"""
+Shared HTTP layer for all spiders: one pooled keep-alive session per host, a per-host concurrency limit and token
+bucket, and backoff honoring Retry-After and X-RateLimit-Remaining/X-RateLimit-Reset.
+requests is only imported once the first session is created, keeping startup cheap for configs without http spiders.
+Requests made inside track() are recorded in its FetchStats (per thread).
+
+"""
+
+_local = threading.local()
+
+
+class FetchStats(object):
+    """
+    Statistics for one spider invocation: time spent, requests and bytes per host, response cache hits and misses
+    """
+    def __init__(self, spider=None):
+        self.spider = spider
+        self.latency = 0.0
+        self.hosts = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.error = None
+
+    def add_request(self, host, seconds, size=0):
+        stats = self.hosts.setdefault(host, {'requests': 0, 'seconds': 0.0, 'bytes': 0})
+        stats['requests'] += 1
+        stats['seconds'] += seconds
+        stats['bytes'] += size
+
+    def add_bytes(self, host, size):
+        self.hosts.setdefault(host, {'requests': 0, 'seconds': 0.0, 'bytes': 0})['bytes'] += size
+
+    @property
+    def requests(self):
+        return sum(h['requests'] for h in self.hosts.values())
+
+    @property
+    def bytes(self):
+        return sum(h['bytes'] for h in self.hosts.values())
+
+    def to_dict(self):
+        return {
+            'spider': self.spider,
+            'latency_ms': round(self.latency * 1000, 1),
+            'requests': self.requests,
+            'bytes': self.bytes,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'hosts': self.hosts,
+            'error': {'type': type(self.error).__name__, 'message': str(self.error)} if self.error else None,
+        }
+
+
+@contextlib.contextmanager
+def track(spider=None):
+    """Record the requests made by the current thread in a new FetchStats"""
+    _local.stats = FetchStats(spider)
+    try:
+        yield _local.stats
+    finally:
+        _local.stats = None
+
+
+def current_stats():
+    """The FetchStats of the enclosing track() on this thread, None if not tracking"""
+    return getattr(_local, 'stats', None)
+
+
+def _retry_after(response, now):
+    """Seconds to wait according to the Retry-After header (delta seconds or http date), None if not present"""
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+
+    if value.strip().isdigit():
+        return int(value)
+
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - now, 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _rate_limit_reset(response, now):
+    """Seconds until the rate limit resets if the server says we have no requests left, None otherwise"""
+    remaining = response.headers.get('X-RateLimit-Remaining')
+    reset = response.headers.get('X-RateLimit-Reset')
+    if remaining is None or reset is None or remaining.strip() != '0':
+        return None
+
+    try:
+        return max(float(reset) - now, 0)
+    except ValueError:
+        return None
+
+
+class HostLimiter(object):
+    """
+    Limits concurrent requests to max_concurrency and the request rate to rate requests/second (with bursts of up to
+    burst requests) for one host. block() pauses all requests to the host, e.g. when throttled.
+    """
+    def __init__(self, max_concurrency, rate, burst):
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        self.semaphore.acquire()
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def release(self):
+        self.semaphore.release()
+
+    def block(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def _release_on_close(response, limiter):
+    """Release the limiter slot held by a streamed response (once) when the response is closed"""
+    close = response.close
+    # Only the first close acquires it
+    once = threading.Lock()
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            if once.acquire(blocking=False):
+                limiter.release()
+
+    response.close = close_and_release
+
+
+class Transport(object):
+    """
+    Pooled, rate limited HTTP client. Throttled responses (429/503, or 403 with no rate limit remaining) are retried up
+    to max_retries times, waiting as told by the server or with exponential backoff, but never longer than max_wait
+    seconds (the throttled response is returned instead). A streamed response (stream=True) counts against the
+    concurrency limit of its host until it is closed.
+    rewrites maps url prefixes to replacements, e.g. to point spiders at a local replay server.
+    """
+    def __init__(self, max_concurrency=4, rate=10.0, burst=10, max_retries=3, max_wait=60, rewrites=None):
+        self.rewrites = rewrites or {}
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.sessions = {}
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        for (prefix, replacement) in self.rewrites.items():
+            if url.startswith(prefix):
+                url = replacement + url[len(prefix):]
+                break
+
+        host = urlparse(url).netloc
+        (session, limiter) = self._for_host(host)
+        attempt = 0
+        while True:
+            limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = session.request(method, url, **kwargs)
+            except BaseException:
+                limiter.release()
+                raise
+
+            if kwargs.get('stream'):
+                # The body is still being downloaded, the host slot is only released when the response is closed
+                _release_on_close(response, limiter)
+            else:
+                limiter.release()
+
+            stats = current_stats()
+            if stats:
+                # Streamed bodies are counted as they are read, see add_bytes
+                size = 0 if kwargs.get('stream') else len(response.content)
+                stats.add_request(host, time.perf_counter() - start, size)
+
+            now = time.time()
+            reset = _rate_limit_reset(response, now)
+            if reset is not None:
+                limiter.block(min(reset, self.max_wait))
+
+            throttled = response.status_code in (429, 503) or (response.status_code == 403 and reset is not None)
+            if not throttled or attempt >= self.max_retries:
+                return response
+
+            wait = _retry_after(response, now)
+            if wait is None:
+                wait = reset if reset is not None else 2 ** attempt
+            if wait > self.max_wait:
+                return response
+
+            limiter.block(wait)
+            response.close()
+            attempt += 1
+
+    def _for_host(self, host):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers['Accept-Encoding'] = 'gzip, deflate'
+                self.sessions[host] = session
+                self.limiters[host] = HostLimiter(self.max_concurrency, self.rate, self.burst)
+
+            return self.sessions[host], self.limiters[host]
+
+
+_transport = Transport()
+
+
+def configure(**kwargs):
+    """Replace the shared transport, see Transport for the available settings"""
+    global _transport
+    _transport = Transport(**kwargs)
+
+
+def get(url, **kwargs):
+    return _transport.get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    return _transport.post(url, **kwargs)
@@ -0,0 +1,73 @@
+import functools
+import heapq
+import re
+
+"""
+Version keys: parse a tag once into a comparable (and cached) key instead of natural sorting raw tag strings.
+
+"""
+
+_version_pattern = re.compile(r'^(\d+(?:\.\d+)*)(.*)$')
+_prerelease_pattern = re.compile(r'^(dev|snapshot|alpha|a|beta|b|milestone|m|preview|pre|rc|cr)[-._]?(\d*)$')
+_prerelease_rank = {
+    'dev': 0, 'snapshot': 0,
+    'alpha': 1, 'a': 1,
+    'beta': 2, 'b': 2,
+    'milestone': 3, 'm': 3, 'preview': 3, 'pre': 3,
+    'rc': 4, 'cr': 4,
+}
+_part_pattern = re.compile(r'\d+|[a-z]+')
+
+_PRERELEASE = 0
+_RELEASE = 1
+_POSTRELEASE = 2
+
+
+@functools.lru_cache(maxsize=16384)
+def parse(tag):
+    """
+    Parse tag into a comparable key, returns None if tag doesn't contain a version.
+    Handles the same prefixes as the spiders (v, release-). A pre-release suffix (1.2.3-rc1, 1.2.3-beta.2,
+    1.2.3-beta-1) sorts before the release, any other suffix (1.2.3-1, 1.2.3-alpine) after it.
+    """
+    candidate = tag.lstrip('v')
+    if candidate.startswith('release-'):
+        candidate = candidate[len('release-'):]
+
+    match = _version_pattern.match(candidate)
+    if not match:
+        return None
+
+    numbers = [int(x) for x in match.group(1).split('.')]
+    while len(numbers) > 1 and numbers[-1] == 0:
+        numbers.pop()
+
+    suffix = match.group(2).lstrip('-.+_').lower()
+    if not suffix:
+        return tuple(numbers), _RELEASE, ()
+
+    prerelease = _prerelease_pattern.match(suffix)
+    if prerelease:
+        return tuple(numbers), _PRERELEASE, (_prerelease_rank[prerelease.group(1)], int(prerelease.group(2) or 0))
+
+    parts = tuple((int(p), '') if p.isdigit() else (-1, p) for p in _part_pattern.findall(suffix))
+    return tuple(numbers), _POSTRELEASE, parts
+
+
+def contains_version(tag):
+    return parse(tag) is not None
+
+
+def top(tags, k):
+    """
+    The k highest versions in tags (highest first), tags without a version are ignored
+    """
+    return heapq.nlargest(k, (t for t in tags if parse(t) is not None), key=parse)
+
+
+def latest(tags):
+    """
+    The highest version in tags or None if no tag contains a version
+    """
+    found = top(tags, 1)
+    return found[0] if found else None
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+import unittest
+
+from spiders import version
+
+
+class ParseTest(unittest.TestCase):
+    def test_prerelease_sorts_before_release(self):
+        for tag in ('1.2.3-rc1', '1.2.3-beta.2', '1.2.3-beta-1', '1.2.3-rc-2', '1.2.3-alpha_1', '1.2.3rc1'):
+            with self.subTest(tag=tag):
+                self.assertLess(version.parse(tag), version.parse('1.2.3'))
+                self.assertGreater(version.parse(tag), version.parse('1.2.2'))
+
+    def test_prerelease_order(self):
+        tags = ['1.2.3', '1.2.3-rc-2', '1.2.3-rc1', '1.2.3-beta-1', '1.2.3-alpha.3', '1.2.3-dev']
+        self.assertEqual(tags, sorted(reversed(tags), key=version.parse, reverse=True))
+
+    def test_postrelease_sorts_after_release(self):
+        for tag in ('1.2.3-1', '1.2.3-alpine', '1.2.3_2'):
+            with self.subTest(tag=tag):
+                self.assertGreater(version.parse(tag), version.parse('1.2.3'))
+                self.assertLess(version.parse(tag), version.parse('1.2.4'))
+
+    def test_prefixes(self):
+        for tag in ('v1.2.3', 'release-1.2.3', 'vrelease-1.2.3', '1.2.3.0'):
+            with self.subTest(tag=tag):
+                self.assertEqual(version.parse('1.2.3'), version.parse(tag))
+
+    def test_not_a_version(self):
+        for tag in ('latest', 'nightly', 'sha-52e6b43', ''):
+            with self.subTest(tag=tag):
+                self.assertIsNone(version.parse(tag))
+
+    def test_latest(self):
+        self.assertEqual('1.10.0', version.latest(['1.9.9', 'latest', '1.10.0-rc-1', '1.10.0', '1.2.10']))
+        self.assertIsNone(version.latest(['latest', 'nightly']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,16 @@
 #!/usr/bin/env python3
 import argparse
 import colorama
+import concurrent.futures
+import csv
 import importlib
+import inspect
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
 import yaml
 
 
@@ -11,24 +20,71 @@ class VersionInfo(object):
     """
 
     output_pattern = '{item.name:<20}{color}{item.current_version:<10}{item.latest_version:<10}{reset}'
+    error_pattern = '{item.name:<20}{color}{item.current_version:<10}{item.latest_version:<10}{item.error}{reset}'
 
-    def __init__(self, name, current_version, latest_versions):
+    def __init__(self, name, current_version, latest_versions, errors=None, stats=None):
+        """
+        errors holds the SpiderError of each block (current, latest) that failed, the version of a failed block is N/A
+        """
         self.name = name
         self.current_version = current_version
         self.latest_version = latest_versions
+        self.errors = errors or {}
+        self.stats = stats or {}
+
+    @property
+    def error(self):
+        """The errors of the current and latest blocks as one message, None if both resolved"""
+        if not self.errors:
+            return None
+        return '; '.join(str(self.errors[block]) for block in ('current', 'latest') if block in self.errors)
+
+    def to_record(self):
+        """Machine readable version of this object, including the fetch stats of the current and latest spiders"""
+        record = {
+            'name': self.name,
+            'current': self.current_version,
+            'latest': self.latest_version,
+            'up_to_date': self.error is None and self.current_version == self.latest_version,
+            'error': self.error,
+        }
+        for block in ('current', 'latest'):
+            error = self.errors.get(block)
+            record['{block}_error'.format(block=block)] = str(error) if error else None
+            stats = self.stats.get(block)
+            record['{block}_fetch'.format(block=block)] = stats.to_dict() if stats else None
+        return record
 
     def __str__(self):
         """Colored column console output of this object"""
+        if self.error:
+            return self.error_pattern.format(item=self, color=colorama.Fore.YELLOW, reset=colorama.Style.RESET_ALL)
+
         color = colorama.Fore.GREEN
         if self.current_version != self.latest_version:
             color = colorama.Fore.RED
         return self.output_pattern.format(item=self, color=color, reset=colorama.Style.RESET_ALL)
 
 
+class SpiderError(Exception):
+    """
+    Raised when a spider fails, keeps track of the config block that failed
+    """
+    def __init__(self, config, cause):
+        super().__init__("{name} failed: {cause}".format(name=config['name'], cause=cause))
+        self.config = config
+        self.cause = cause
+
+
 class Versions(object):
-    def __init__(self, config_file, beautify):
+    def __init__(self, config_file, beautify, github=None):
+        """
+        github is an optional spiders.github.GithubGraphQL backend used to prefetch all github spiders in a scan
+        """
         self.config = Versions._init(config_file)
+        self.spider_classes = Versions._resolve_spiders(self.config)
         self.beautify = beautify
+        self.github = github
 
     @staticmethod
     def _init(config_file):
@@ -37,35 +93,340 @@ class Versions(object):
 
         return sorted(config_yaml['versions'], key=lambda x: x['name'])
 
-    def scan(self):
+    @staticmethod
+    def _resolve_spiders(config):
+        """
+        Resolve the spider class of every config block once, validating spider names and params up front. Only the
+        (heavy) modules required by the spiders actually in use are imported.
+        """
+        spiders = importlib.import_module("spiders")
+        spider_classes = {}
+        problems = []
+        for conf in config:
+            for block in ('current', 'latest'):
+                try:
+                    spider_config = conf[block]
+                    spider_class = spiders.get_spider_class(spider_config['name'])
+                    inspect.signature(spider_class).bind(**spider_config.get('params', {}))
+                    spider_classes[spider_config['name']] = spider_class
+                except (KeyError, TypeError, ValueError) as e:
+                    problems.append("{name} ({block}): {error}".format(name=conf.get('name'), block=block, error=e))
+
+        if problems:
+            raise ValueError("Invalid config:\n  {problems}".format(problems='\n  '.join(problems)))
+
+        for spider_class in set(spider_classes.values()):
+            for module in spider_class.requires:
+                importlib.import_module(module)
+
+        return spider_classes
+
+    def plan(self):
+        """
+        Create one spider per unique spider invocation (same spider, params and beautify setting) in the config.
+        Returns the items as [(name, (current key, latest key))], the spiders as {key: (config, spider)} and the
+        errors for spiders that could not be created as {key: SpiderError}. saved_fetches is set to the number of
+        invocations deduplicated.
+        """
+        self.saved_fetches = 0
+        spiders = {}
+        errors = {}
+        items = []
         for conf in self.config:
-            yield VersionInfo(conf['name'], self.get_version(conf['current']), self.get_version(conf['latest']))
+            keys = []
+            for config in (conf['current'], conf['latest']):
+                key = self._fetch_key(config)
+                if key in spiders or key in errors:
+                    self.saved_fetches += 1
+                else:
+                    try:
+                        spiders[key] = (config, self.create_spider(config))
+                    except SpiderError as e:
+                        errors[key] = e
+                keys.append(key)
+            items.append((conf['name'], tuple(keys)))
 
-    def get_version(self, config):
+        return items, spiders, errors
+
+    def scan(self, jobs=1):
         """
-        Dynamically invoke the spider matching the given config to retrieve version
+        Resolve all configured versions using up to jobs worker threads. Items are yielded in (name) config order as
+        soon as they are resolved, a failing spider is reported on its item instead of aborting the scan.
+        Identical spider invocations are only fetched once per scan (see plan), the number of fetches saved that way
+        is available in saved_fetches afterwards, the spiders used in spiders.
+        """
+        (items, spiders, errors) = self.plan()
+        fetches = {}
+        for (key, error) in errors.items():
+            fetches[key] = concurrent.futures.Future()
+            fetches[key].set_exception(error)
+
+        self.spiders = [spider for (_, spider) in spiders.values()]
+        self._prefetch(self.spiders)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            for (key, (config, spider)) in spiders.items():
+                fetches[key] = executor.submit(self._get_version, config, spider)
+
+            for (name, (current, latest)) in items:
+                item = self._version_info(name, fetches[current], fetches[latest])
+                item.stats = {block: getattr(spiders[key][1], 'fetch_stats', None)
+                              for (block, key) in (('current', current), ('latest', latest)) if key in spiders}
+                yield item
+
+    def _prefetch(self, spider_list):
+        if not self.github:
+            return
+
+        spiders = importlib.import_module("spiders")
+        github_spiders = [s for s in spider_list
+                          if isinstance(s, (spiders.GithubReleaseSpider, spiders.GithubMixedReleaseSpider))]
+        for spider in github_spiders:
+            spider.prefetched = None
+
+        try:
+            self.github.prefetch(github_spiders)
+        except Exception as e:
+            print("Github GraphQL prefetch failed, falling back to REST: {e}".format(e=e), file=sys.stderr)
+
+    @staticmethod
+    def _version_info(name, current, latest):
+        """
+        VersionInfo from the current and latest fetches, each resolved on its own so a failing block doesn't hide the
+        version (or error) of the other one
+        """
+        versions = {}
+        errors = {}
+        for (block, fetch) in (('current', current), ('latest', latest)):
+            try:
+                versions[block] = fetch.result()
+            except SpiderError as e:
+                versions[block] = 'N/A'
+                errors[block] = e
+        return VersionInfo(name, versions['current'], versions['latest'], errors)
+
+    def _fetch_key(self, config):
+        """Normalized key identifying a spider invocation, used to deduplicate fetches within a scan"""
+        return config['name'], json.dumps(config.get('params', {}), sort_keys=True), self.beautify
+
+    def create_spider(self, config):
+        """
+        Create the spider matching the given config (using the spider classes resolved when loading the config)
         """
-        spider_class = getattr(importlib.import_module("spiders"), config['name'])
-        spider = spider_class(**config['params'])
-        version = 'N/A'
         try:
-            version = spider.get_version(self.beautify)
+            spider_class = self.spider_classes[config['name']]
+            spider = spider_class(**config.get('params', {}))
+            if 'cache_ttl' in config:
+                spider.cache_ttl = config['cache_ttl']
+            return spider
         except Exception as e:
-            print("Config {config} failed...".format(config=config))
-            raise e
+            raise SpiderError(config, e) from e
+
+    def get_version(self, config):
+        """
+        Dynamically invoke the spider matching the given config to retrieve version
+        """
+        return self._get_version(config, self.create_spider(config))
+
+    def _get_version(self, config, spider):
+        """
+        Invoke spider, recording latency, requests, bytes and cache hits/misses in spider.fetch_stats
+        """
+        transport = importlib.import_module("spiders.transport")
+        with transport.track(type(spider).__name__) as stats:
+            start = time.perf_counter()
+            try:
+                return spider.get_version(self.beautify)
+            except Exception as e:
+                stats.error = e
+                raise SpiderError(config, e) from e
+            finally:
+                stats.latency = time.perf_counter() - start
+                spider.fetch_stats = stats
 
-        return version
+
+CSV_FIELDS = ['name', 'current', 'latest', 'up_to_date', 'error'] + [
+    '{block}_{field}'.format(block=block, field=field) for block in ('current', 'latest')
+    for field in ('spider', 'latency_ms', 'requests', 'bytes', 'cache_hits', 'cache_misses', 'error')
+]
+
+
+def write_items(items, output_format, stream=sys.stdout):
+    """
+    Write items (VersionInfo) to stream as a colored table, json, ndjson or csv, each item as soon as it is resolved
+    """
+    if output_format == 'table':
+        print("{:<20}{:<10}{:<10}".format('Name', 'Current', 'Latest'), file=stream)
+        for item in items:
+            print(item, file=stream)
+        return
+
+    if output_format == 'csv':
+        writer = csv.DictWriter(stream, CSV_FIELDS)
+        writer.writeheader()
+
+    separator = '[\n'
+    for item in items:
+        record = item.to_record()
+        if output_format == 'json':
+            stream.write(separator)
+            separator = ',\n'
+            stream.write(json.dumps(record))
+        elif output_format == 'ndjson':
+            stream.write(json.dumps(record) + '\n')
+        else:
+            row = {field: record[field] for field in CSV_FIELDS if field in record}
+            for block in ('current', 'latest'):
+                fetch = record['{block}_fetch'.format(block=block)] or {}
+                for (field, value) in fetch.items():
+                    # {block}_error is in the record, also set when the spider could not be created
+                    if field == 'error':
+                        continue
+                    row['{block}_{field}'.format(block=block, field=field)] = value
+            writer.writerow({field: value for (field, value) in row.items() if field in CSV_FIELDS})
+        stream.flush()
+
+    if output_format == 'json':
+        stream.write('[]\n' if separator == '[\n' else '\n]\n')
+
+
+def summarize(spiders):
+    """
+    Lines summarizing where scan time was spent, by spider class and by host (including kubectl)
+    """
+    by_class = {}
+    by_host = {}
+    for spider in spiders:
+        stats = getattr(spider, 'fetch_stats', None)
+        if stats is None:
+            continue
+
+        totals = by_class.setdefault(stats.spider, {'calls': 0, 'seconds': 0.0, 'requests': 0, 'bytes': 0, 'errors': 0})
+        totals['calls'] += 1
+        totals['seconds'] += stats.latency
+        totals['requests'] += stats.requests
+        totals['bytes'] += stats.bytes
+        totals['errors'] += int(stats.error is not None)
+        for (host, host_stats) in stats.hosts.items():
+            totals = by_host.setdefault(host, {'requests': 0, 'seconds': 0.0, 'bytes': 0})
+            for field in totals:
+                totals[field] += host_stats[field]
+
+    lines = ["{:<32}{:>7}{:>12}{:>10}{:>12}{:>8}".format('Spider', 'Calls', 'Time s', 'Requests', 'Bytes', 'Errors')]
+    for (name, totals) in sorted(by_class.items(), key=lambda x: x[1]['seconds'], reverse=True):
+        lines.append("{name:<32}{t[calls]:>7}{t[seconds]:>12.3f}{t[requests]:>10}{t[bytes]:>12}{t[errors]:>8}".format(
+            name=name, t=totals)
+        )
+    lines.append("{:<32}{:>7}{:>12}{:>10}{:>12}".format('Host', '', 'Time s', 'Requests', 'Bytes'))
+    for (host, totals) in sorted(by_host.items(), key=lambda x: x[1]['seconds'], reverse=True):
+        lines.append("{host:<32}{empty:>7}{t[seconds]:>12.3f}{t[requests]:>10}{t[bytes]:>12}".format(
+            host=host, empty='', t=totals)
+        )
+    return lines
+
+
+def profile_startup(config_file):
+    """
+    Print the time spent importing modules (python -X importtime) and loading config_file in a fresh interpreter
+    """
+    code = "import time; start = time.perf_counter(); import versions; versions.Versions({config!r}, True); " \
+           "print(time.perf_counter() - start)".format(config=os.path.abspath(config_file))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=os.path.dirname(__file__) or '.',
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8', check=True)
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and 'cumulative' not in line:
+            (_, cumulative, name) = line[len('import time:'):].split('|')
+            # Nested imports are indented, only report the top level ones
+            if not name[1:].startswith(' '):
+                imports.append((int(cumulative), name.strip()))
+
+    print("{:<40}{:>12}".format('Module', 'Import ms'))
+    for (cumulative, name) in sorted(imports, reverse=True)[:20]:
+        print("{name:<40}{ms:>12.1f}".format(name=name, ms=cumulative / 1000))
+    print("{:<40}{:>12.1f}".format('Total imports', sum(c for (c, _) in imports) / 1000))
+    print("{:<40}{:>12.1f}".format('Startup (imports + config load)', float(result.stdout) * 1000))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", default="config.yaml", help="Specify your own configuration file")
     parser.add_argument("--ugly", action="store_true", default=False, help="Do not beautify versions")
+    parser.add_argument("--jobs", type=int, default=8, help="Number of spiders to run concurrently")
+    parser.add_argument("--cache-dir", help="Cache spider HTTP responses in this directory between runs")
+    parser.add_argument("--cache-size", type=int, default=50, help="Max size of the response cache in MB")
+    parser.add_argument("--kube-snapshot", nargs='?', const='', metavar='FILE',
+                        help="List each kubernetes (namespace, kind) once for all kubernetes spiders, "
+                             "optionally reading a saved 'kubectl get ... -o json' file instead of calling kubectl")
+    parser.add_argument("--github-graphql", action="store_true", default=False,
+                        help="Resolve all Github spiders using batched GraphQL queries (requires GITHUB_TOKEN)")
+    parser.add_argument("--github-batch-size", type=int, default=50, help="Repositories per GraphQL query")
+    parser.add_argument("--host-concurrency", type=int, default=4, help="Max concurrent requests per host")
+    parser.add_argument("--host-rate", type=float, default=10.0, help="Max requests per second per host")
+    parser.add_argument("--memory-stats", action="store_true", default=False,
+                        help="Report bytes read and peak memory for the streaming (HTML) spiders, runs the spiders "
+                             "one at a time (--jobs 1) as tracemalloc measures the whole process")
+    parser.add_argument("--watch", action="store_true", default=False,
+                        help="Keep running, refreshing each source on its own interval and serving the results")
+    parser.add_argument("--interval", type=int, default=300,
+                        help="Default seconds between refreshes of a source in watch mode (config blocks may set "
+                             "their own interval)")
+    parser.add_argument("--listen", default="127.0.0.1:8000",
+                        help="host:port serving /versions.json and /metrics in watch mode")
+    parser.add_argument("--profile-startup", action="store_true", default=False,
+                        help="Report import and config load times for the given config and exit")
+    parser.add_argument("--format", choices=['table', 'json', 'ndjson', 'csv'], default='table',
+                        help="Output format, machine readable formats include per spider fetch stats and send the "
+                             "summary to stderr")
     args = parser.parse_args()
 
+    if args.profile_startup:
+        profile_startup(args.config)
+        sys.exit(0)
+
+    github = None
+    if args.github_graphql:
+        if 'GITHUB_TOKEN' not in os.environ:
+            parser.error("--github-graphql requires a GITHUB_TOKEN environment variable")
+        github = importlib.import_module("spiders.github").GithubGraphQL(
+            os.environ['GITHUB_TOKEN'], args.github_batch_size
+        )
+
+    if args.memory_stats:
+        # Concurrent spiders would reset each other's peak and count each other's allocations
+        args.jobs = 1
+        tracemalloc.start()
+
     colorama.init()
+    spiders = importlib.import_module("spiders")
+    spiders.transport.configure(max_concurrency=args.host_concurrency, rate=args.host_rate)
+    spiders.configure_cache(args.cache_dir, args.cache_size * 1024 * 1024)
+    spiders.configure_kubernetes_snapshot(args.kube_snapshot is not None, args.kube_snapshot or None)
+
+    versions = Versions(args.config, not args.ugly, github)
+    if args.watch:
+        watch = importlib.import_module("watch")
+        watcher = watch.Watcher(versions, args.interval, jobs=args.jobs)
+        (host, port) = args.listen.rsplit(':', 1)
+        watch.serve(watcher, host, int(port))
+        print("Serving http://{listen}/versions.json and http://{listen}/metrics".format(listen=args.listen))
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            sys.exit(0)
+
+    write_items(versions.scan(args.jobs), args.format)
+
+    summary = sys.stdout if args.format == 'table' else sys.stderr
+    print("{count} fetches saved by deduplication".format(count=versions.saved_fetches), file=summary)
+    for line in summarize(versions.spiders):
+        print(line, file=summary)
 
-    versions = Versions(args.config, not args.ugly)
-    print("{:<20}{:<10}{:<10}".format('Name', 'Current', 'Latest'))
-    for item in versions.scan():
-        print(item)
+    if args.memory_stats:
+        for spider in versions.spiders:
+            if isinstance(spider, spiders.AbstractStreamingSpider):
+                print("{name:<30}{bytes:>12} bytes read{peak:>12} bytes peak memory".format(
+                    name=type(spider).__name__, bytes=spider.bytes_read, peak=spider.peak_memory or 0),
+                    file=summary
+                )
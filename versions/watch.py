@@ -0,0 +1,153 @@
+import concurrent.futures
+import http.server
+import importlib
+import json
+import random
+import threading
+import time
+
+"""
+Watch mode for versions: keeps all spiders in memory, refreshes every source on its own interval and serves the latest
+results as JSON (/versions.json) and Prometheus text (/metrics) from a small local HTTP endpoint.
+
+"""
+
+
+class Source(object):
+    """
+    One unique spider invocation. result is a done Future holding the latest version (or error), None until the first
+    refresh has completed.
+    """
+    def __init__(self, config, spider, interval):
+        self.config = config
+        self.spider = spider
+        self.interval = interval
+        self.next_run = 0
+        self.running = False
+        self.result = None
+        self.updated = None
+
+
+class Watcher(object):
+    """
+    Refreshes the sources of a Versions config, each source every interval seconds (or the interval set on its config
+    block) +/- jitter (fraction of the interval) so sources don't all end up being fetched at the same time.
+    """
+    def __init__(self, versions, interval=300, jitter=0.1, jobs=8):
+        self.versions = versions
+        self.jitter = jitter
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        (self.items, spiders, errors) = versions.plan()
+        self.sources = {key: Source(config, spider, config.get('interval', interval))
+                        for (key, (config, spider)) in spiders.items()}
+        self.errors = {}
+        for (key, error) in errors.items():
+            self.errors[key] = concurrent.futures.Future()
+            self.errors[key].set_exception(error)
+
+    def run(self):
+        """Refresh due sources until interrupted"""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while True:
+                with self.lock:
+                    now = time.time()
+                    due = [s for s in self.sources.values() if not s.running and s.next_run <= now]
+                    for source in due:
+                        source.running = True
+
+                if due:
+                    # Otherwise kubernetes sources would keep serving the listing made by their first refresh
+                    importlib.import_module("spiders").invalidate_kubernetes_snapshot([s.spider for s in due])
+                    self.versions._prefetch([s.spider for s in due])
+                    for source in due:
+                        executor.submit(self._refresh, source)
+
+                with self.lock:
+                    waiting = [s.next_run for s in self.sources.values() if not s.running]
+                time.sleep(min(max(min(waiting, default=now + 1) - time.time(), 0.1), 1.0))
+
+    def _refresh(self, source):
+        result = concurrent.futures.Future()
+        try:
+            result.set_result(self.versions._get_version(source.config, source.spider))
+        except Exception as e:
+            result.set_exception(e)
+
+        with self.lock:
+            source.result = result
+            source.updated = time.time()
+            source.next_run = source.updated + source.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+            source.running = False
+
+    def version_infos(self):
+        """The latest VersionInfo for every item with both its sources resolved at least once"""
+        with self.lock:
+            results = {key: source.result for (key, source) in self.sources.items() if source.result}
+            results.update(self.errors)
+
+        return [self.versions._version_info(name, results[current], results[latest])
+                for (name, (current, latest)) in self.items if current in results and latest in results]
+
+    def to_json(self):
+        return json.dumps([{
+            'name': item.name,
+            'current': item.current_version,
+            'latest': item.latest_version,
+            'up_to_date': item.error is None and item.current_version == item.latest_version,
+            'error': item.error,
+            'current_error': str(item.errors['current']) if 'current' in item.errors else None,
+            'latest_error': str(item.errors['latest']) if 'latest' in item.errors else None,
+        } for item in self.version_infos()], indent=2)
+
+    def to_prometheus(self):
+        up_to_date = []
+        errors = []
+        for item in self.version_infos():
+            labels = 'name="{name}",current="{current}",latest="{latest}"'.format(
+                name=_escape(item.name), current=_escape(item.current_version), latest=_escape(item.latest_version)
+            )
+            up_to_date.append('versions_up_to_date{{{labels}}} {value}'.format(
+                labels=labels, value=int(item.error is None and item.current_version == item.latest_version))
+            )
+            for block in ('current', 'latest'):
+                errors.append('versions_error{{name="{name}",block="{block}"}} {value}'.format(
+                    name=_escape(item.name), block=block, value=int(block in item.errors))
+                )
+
+        lines = ['# HELP versions_up_to_date 1 if the current version is the latest version',
+                 '# TYPE versions_up_to_date gauge'] + up_to_date
+        lines += ['# HELP versions_error 1 if resolving the version of the block (current or latest) failed',
+                  '# TYPE versions_error gauge'] + errors
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def serve(watcher, host='127.0.0.1', port=8000):
+    """Serve the watcher results from a background thread, returns the server"""
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path in ('/', '/versions.json'):
+                (body, content_type) = (watcher.to_json(), 'application/json')
+            elif self.path == '/metrics':
+                (body, content_type) = (watcher.to_prometheus(), 'text/plain; version=0.0.4')
+            else:
+                self.send_error(404)
+                return
+
+            data = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server